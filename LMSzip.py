@@ -2,17 +2,39 @@ from __future__ import division, print_function, absolute_import
 import argparse
 import zipfile
 import os
+import shutil
+import threading
+import time
+import sqlite3
+import tempfile
+from collections.abc import Mapping
+from concurrent.futures import ThreadPoolExecutor
 
-def fill_namedict(fname='name_map.txt'):
-    # Заполнение словаря имен
-    d = {}
-    with open(fname, 'r', encoding='utf8') as f: 
+from cache import digest, private_folder
+
+# The default folder for the roster indexes, see `Roster`, one per user.
+ROSTER_DIR = os.path.join(tempfile.gettempdir(),
+                          "marker-roster-%s" % os.getuid())
+
+
+def _iter_map(fname):
+    """Iterate over the ``(lms_id, value)`` pairs of the lines of a map.
+
+    Skips blank lines and ``#`` comments. The value is None if missing.
+    """
+    with open(fname, 'r', encoding='utf8') as f:
         for line in f:
             if line.startswith("#"):
                 continue
-            k = line.replace("\n","").split(None, 1)
-            d[k[0]] = k[1]
-    return d
+            k = line.split(None, 1)
+            if not k:
+                continue
+            yield k[0], k[1].strip() if len(k) > 1 else None
+
+
+def fill_namedict(fname='name_map.txt'):
+    # Заполнение словаря имен
+    return dict(_iter_map(fname))
 
 
 class Student(object):
@@ -20,6 +42,8 @@ class Student(object):
 
     Also may hold the marking results (mark, log etc)
     """
+    __slots__ = ("lms_id", "_name", "_list_num", "mark", "log")
+
     def __init__(self, lms_id, name=None, list_num=None):
         self.lms_id = lms_id
         self._name = name
@@ -40,56 +64,237 @@ class Student(object):
             return -1
 
 
+class Roster(Mapping):
+    """The cohort, a read-only mapping ``{lms_id: Student}``.
+
+    The name and number maps are parsed into an SQLite index in `index_dir`
+    (`ROSTER_DIR` by default, private to the user, see
+    `cache.private_folder`) once, and only parsed again when either of them
+    changes, by mtime and size. A lookup queries the index and builds the `Student` on demand, so
+    that marking a single submission does not parse the maps at all.
+
+    A student who is in one of the maps only has no name or no number, see
+    `Student`.
+    """
+    def __init__(self, name_dict_fname="name_map.txt",
+                 num_dict_fname="number_map.txt", index_dir=None):
+        self.fnames = (os.path.abspath(name_dict_fname),
+                       os.path.abspath(num_dict_fname))
+        index_dir = private_folder(index_dir or ROSTER_DIR)
+        self.index_path = os.path.join(index_dir,
+                                       digest(*self.fnames) + ".sqlite")
+        self._lock = threading.Lock()
+        self._conn = None
+        self._stamp = None
+        self._students = {}
+
+    def _stamps(self):
+        stats = [os.stat(fname) for fname in self.fnames]
+        return " ".join("%s:%s" % (st.st_mtime_ns, st.st_size)
+                        for st in stats)
+
+    def _index(self):
+        """The connection to the index, rebuilt if the maps changed. Call
+        with the lock held."""
+        stamp = self._stamps()
+        if self._conn is not None and stamp == self._stamp:
+            return self._conn
+        if self._conn is None:
+            self._conn = sqlite3.connect(self.index_path,
+                                         check_same_thread=False)
+            self._conn.execute("CREATE TABLE IF NOT EXISTS meta "
+                               "(stamp TEXT)")
+            self._conn.execute("CREATE TABLE IF NOT EXISTS roster "
+                               "(lms_id TEXT PRIMARY KEY, name TEXT, "
+                               "list_num TEXT)")
+        row = self._conn.execute("SELECT stamp FROM meta").fetchone()
+        if row is None or row[0] != stamp:
+            self._build(stamp)
+        self._stamp = stamp
+        self._students = {}
+        return self._conn
+
+    def _build(self, stamp):
+        names = fill_namedict(self.fnames[0])
+        nums = fill_namedict(self.fnames[1])
+        lms_ids = list(names) + [_ for _ in nums if _ not in names]
+        with self._conn:
+            self._conn.execute("DELETE FROM roster")
+            self._conn.execute("DELETE FROM meta")
+            self._conn.executemany(
+                "INSERT INTO roster VALUES (?, ?, ?)",
+                [(_, names.get(_), nums.get(_)) for _ in lms_ids])
+            self._conn.execute("INSERT INTO meta VALUES (?)", (stamp,))
+
+    def __getitem__(self, lms_id):
+        with self._lock:
+            conn = self._index()
+            try:
+                return self._students[lms_id]
+            except KeyError:
+                pass
+            row = conn.execute("SELECT name, list_num FROM roster "
+                               "WHERE lms_id = ?", (lms_id,)).fetchone()
+            if row is None:
+                raise KeyError(lms_id)
+            student = self._students[lms_id] = Student(lms_id, *row)
+            return student
+
+    def __iter__(self):
+        with self._lock:
+            rows = self._index().execute(
+                "SELECT lms_id FROM roster ORDER BY rowid").fetchall()
+        return iter([_[0] for _ in rows])
+
+    def __len__(self):
+        with self._lock:
+            return self._index().execute(
+                "SELECT COUNT(*) FROM roster").fetchone()[0]
+
+
 def fill_cohort(name_dict_fname="name_map.txt",
                 num_dict_fname="number_map.txt"):
-    """Construct the dict of {lms_id: Student(...)}
+    """Construct the mapping of {lms_id: Student(...)}, see `Roster`.
     """
-    name_dict = fill_namedict(name_dict_fname)
-    num_dict = fill_namedict(num_dict_fname)
+    return Roster(name_dict_fname, num_dict_fname)
 
-    cohort = {}
-    for lms_id in name_dict:
-        student = Student(lms_id=lms_id,
-                          name=name_dict[lms_id],
-                          list_num=num_dict[lms_id])
-        cohort.update({lms_id: student})
-    return cohort
 
+class StudentIndex(object):
+    """Find the lms_id in a file name, for the keys of `name_dict`.
 
-def unpack(zip_fname, name_dict):
-    """Unpack the zip archive into per-student folders
+    A file belongs to the student whose lms_id is a substring of its name;
+    the longest such lms_id wins, then the leftmost one. The lookup only
+    checks the substrings of the lengths of the lms_ids, so it does not
+    depend on the number of students.
+    """
+    def __init__(self, name_dict):
+        self.keys = set(name_dict)
+        self.lengths = sorted(set(len(_) for _ in self.keys), reverse=True)
+
+    def match(self, fname):
+        for length in self.lengths:
+            for j in range(len(fname) - length + 1):
+                if fname[j:j+length] in self.keys:
+                    return fname[j:j+length]
+        return None
+
+
+def _is_submission(fname):
+    return os.path.splitext(fname)[1] in (".py", ".ipynb")
+
+
+def _zip_mtime(info):
+    return time.mktime(info.date_time + (0, 0, -1))
+
+
+def _is_unchanged(info, target):
+    """Whether `target` was extracted from the zip member `info` before."""
+    try:
+        stat = os.stat(target)
+    except OSError:
+        return False
+    return (stat.st_size == info.file_size and
+            int(stat.st_mtime) == int(_zip_mtime(info)))
+
+
+class _Extractor(object):
+    """Extract zip members from several threads, with a ZipFile per thread."""
+    def __init__(self, zip_fname):
+        self.zip_fname = zip_fname
+        self._local = threading.local()
+        self._opened = []
+
+    def _zipfile(self):
+        z = getattr(self._local, "z", None)
+        if z is None:
+            z = self._local.z = zipfile.ZipFile(self.zip_fname, 'r')
+            self._opened.append(z)
+        return z
+
+    def __call__(self, info, target):
+        _extract(self._zipfile(), info, target)
+
+    def close(self):
+        for z in self._opened:
+            z.close()
+
+
+def _extract(z, info, target):
+    """Extract the member `info` of the ZipFile `z` into the file `target`.
+
+    The file is written under a temporary name and then renamed, and gets
+    the mtime of the member, see `_is_unchanged`.
     """
+    os.makedirs(os.path.dirname(target), exist_ok=True)
+    tmp = target + ".part"
+    with z.open(info) as src, open(tmp, 'wb') as dst:
+        shutil.copyfileobj(src, dst)
+    os.replace(tmp, target)
+    mtime = _zip_mtime(info)
+    os.utime(target, (mtime, mtime))
 
-    # XXX: relative paths etc
-    path, fname = os.path.split(zip_fname)
-    os.chdir(path)
 
-    if not zipfile.is_zipfile(fname):
-        raise ValueError("%s is not a zip file" % fname)
+def unpack(zip_fname, name_dict, jobs=4, dest=None):
+    """Unpack the zip archive into per-student folders
 
-    # Открыть архив для чтения и распоковать
-    with zipfile.ZipFile(fname, 'r') as z:
-        z.extractall()
+    A .py or .ipynb file whose path in the archive contains an lms_id (a key
+    of `name_dict`) goes into the folder ``lms_id/`` in `dest`, which is
+    the folder of the archive by default, see `StudentIndex`. Other files
+    are unpacked as they are. Members are extracted by `jobs` threads,
+    directly to where they belong; the ones which have not changed since
+    the previous unpacking, by size and mtime, are skipped.
 
-    # Список имен файлов
-    sps = os.listdir(path=os.getcwd())
+    Returns the dict ``{lms_id: [paths of the files of the student]}``.
+    """
+    path = os.path.dirname(os.path.abspath(zip_fname))
+    if dest is not None:
+        path = os.path.abspath(dest)
+    if not zipfile.is_zipfile(zip_fname):
+        raise ValueError("%s is not a zip file" % zip_fname)
+
+    index = StudentIndex(name_dict)
+    targets, submissions = {}, {}
+    with zipfile.ZipFile(zip_fname, 'r') as z:
+        for info in z.infolist():
+            if info.is_dir():
+                continue
+            lms_id = None
+            if _is_submission(info.filename):
+                lms_id = index.match(info.filename)
+            if lms_id is None:
+                # where ZipFile.extract would put it, sans the checks of
+                # drive letters and illegal characters on Windows
+                target = os.path.join(path, *[
+                    _ for _ in info.filename.split("/")
+                    if _ not in ("", ".", "..")])
+            else:
+                target = os.path.join(path, lms_id,
+                                      os.path.basename(info.filename))
+                submissions.setdefault(lms_id, []).append(target)
+            # a later member with the same target wins, as with extractall
+            targets[target] = info
 
-    for fname in sps:
-        # Проверка является ли файл .py или .ipynb
-        if (fname.find(".py") != -1)or(fname.find(".ipynb") != -1):
-            for key in name_dict:
-                if key in fname:
-                    dirnew = os.path.join(os.getcwd(), str(key), fname)
-                    dirold = os.path.join(os.getcwd(), fname)
-                    os.renames(dirold, dirnew)
+    todo = [(info, target) for target, info in targets.items()
+            if not _is_unchanged(info, target)]
+    extractor = _Extractor(zip_fname)
+    try:
+        with ThreadPoolExecutor(max_workers=jobs) as pool:
+            list(pool.map(extractor, [_[0] for _ in todo],
+                          [_[1] for _ in todo]))
+    finally:
+        extractor.close()
+    return {lms_id: sorted(set(paths))
+            for lms_id, paths in submissions.items()}
 
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser()
     parser.add_argument("path",
                         help="Path to the zip file from LMS.")
+    parser.add_argument("--jobs", "-j", type=int, default=4,
+                        help="Number of threads to unpack with (default: 4).")
     args = parser.parse_args()
 
     # fill the name map & unpack
     d = fill_namedict()
-    unpack(args.path, d)
+    unpack(args.path, d, jobs=args.jobs)
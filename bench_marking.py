@@ -0,0 +1,290 @@
+"""
+Benchmark the marking pipeline on a synthetic cohort.
+
+Generate a cohort of N fizzbuzz submissions with a given mix of correct,
+wrong, crashing, syntax-error, slow and timing out scripts (after the
+patterns in FB/), and mark it with `Exercise.mark` in this process ("api")
+and/or with the marking.py CLI in a child process ("cli"). Report the
+throughput in submissions per second, the per-phase latency percentiles
+and the peak memory, and check that the marks are as expected.
+
+Example:
+
+    $ python bench_marking.py -n 200 --mix correct=5,wrong=2,timeout=1 -j 4
+
+With ``--save``, the results go to a JSON file, and ``--compare`` fails
+(exit code 1) if the throughput drops by more than ``--tolerance`` relative
+to a saved file.
+"""
+from __future__ import division, print_function, absolute_import
+
+import argparse
+import json
+import os
+import random
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+import logs
+import sandbox
+from LMSzip import Student
+from marking import ENGINES, setup_logger, get_exercise, mark_cohort
+from report import summarize
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+_FIZZBUZZ = '''\
+def fizzbuzz(n):
+%s
+    for j in range(1, n + 1):
+        if j %% 3 == 0:
+            print("fizz")
+        elif j %% 5 == 0:
+            print("buzz")
+        else:
+            print(j)
+
+
+if __name__ == "__main__":
+    fizzbuzz(int(input("")))
+'''
+
+# kind -> (source, the expected mark with the fizzbuzz checker); a script
+# which compiles gets 20 for that
+KINDS = {
+    "correct": (_FIZZBUZZ % "", 100),
+    "wrong": (_FIZZBUZZ % "    n = min(n, 15)\n", 60),
+    "crash": ("1 / 0\n", 20),
+    "syntax": ("this is not even a valid python file\n", 0),
+    "slow": ("import time\ntime.sleep(0.2)\n" + _FIZZBUZZ % "", 100),
+    "timeout": ("while True:\n    pass\n", 20),
+}
+
+DEFAULT_MIX = "correct=6,wrong=2,crash=1,syntax=1"
+
+
+def parse_mix(mix):
+    """Parse ``"correct=6,wrong=2"`` into ``{"correct": 6, "wrong": 2}``."""
+    res = {}
+    for item in mix.split(","):
+        kind, _, weight = item.partition("=")
+        kind = kind.strip()
+        if kind not in KINDS:
+            raise ValueError("Unknown submission kind %s, expected one of %s."
+                             % (kind, sorted(KINDS)))
+        res[kind] = float(weight) if weight else 1.0
+    return res
+
+
+def make_cohort(folder, n, mix, seed=0):
+    """Write `n` submissions into the subfolders of `folder`.
+
+    The kinds of the submissions are drawn at random with the weights from
+    the dict `mix`. Also writes the name and number maps of the cohort, see
+    `LMSzip.fill_cohort`. Returns the list of ``(lms_id, kind)`` pairs.
+    """
+    rng = random.Random(seed)
+    kinds = sorted(mix)
+    drawn = rng.choices(kinds, weights=[mix[_] for _ in kinds], k=n)
+    cohort = []
+    for j, kind in enumerate(drawn):
+        lms_id = "student_%05d" % j
+        os.makedirs(os.path.join(folder, lms_id))
+        with open(os.path.join(folder, lms_id, "fizzbuzz.py"), "w") as f:
+            f.write(KINDS[kind][0])
+        cohort.append((lms_id, kind))
+
+    with open(os.path.join(folder, "name_map.txt"), "w",
+              encoding="utf8") as names, \
+            open(os.path.join(folder, "number_map.txt"), "w",
+                 encoding="utf8") as numbers:
+        for j, (lms_id, _) in enumerate(cohort):
+            names.write("%s Student %s\n" % (lms_id, j))
+            numbers.write("%s %s\n" % (lms_id, j + 1))
+    return cohort
+
+
+def _wrong_marks(cohort, marks):
+    """The ``(lms_id, kind, mark)`` of the submissions marked unexpectedly."""
+    return [(lms_id, kind, mark)
+            for (lms_id, kind), mark in zip(cohort, marks)
+            if round(mark) != KINDS[kind][1]]
+
+
+def _peak_rss(who):
+    return sandbox.usage_of(resource.getrusage(who))["max_rss"]
+
+
+def bench_api(folder, cohort, checker_kwds, jobs=1, executor="process"):
+    """Mark the cohort in `folder` via `mark_cohort`, in this process.
+
+    The logs go to the log files only, see ``--console-level``.
+    """
+    tasks = [(os.path.join(folder, lms_id), Student(lms_id))
+             for lms_id, _ in cohort]
+
+    logger = setup_logger("root", log_file=os.path.join(folder, "bench.log"))
+    start = time.perf_counter()
+    ex = get_exercise("fizzbuzz", logger, **checker_kwds)
+    marked = mark_cohort(ex, "fizzbuzz", tasks, logger, jobs=jobs,
+                         executor=executor, checker_kwds=checker_kwds)
+    seconds = time.perf_counter() - start
+
+    summary = summarize(marked)
+    return {"seconds": seconds,
+            "submissions_per_second": len(cohort) / seconds,
+            "submission_seconds": summary["submission_seconds"],
+            "phase_seconds": summary["phase_seconds"],
+            "slowest_runs": summary["slowest_runs"],
+            "check_cache": summary["check_cache"],
+            "peak_rss": _peak_rss(resource.RUSAGE_SELF),
+            "peak_rss_children": _peak_rss(resource.RUSAGE_CHILDREN),
+            "wrong_marks": _wrong_marks(cohort,
+                                        [_["mark"] for _ in marked])}
+
+
+def bench_cli(folder, cohort, cli_args):
+    """Mark the cohort in `folder` with the marking.py CLI.
+
+    The peak RSS is that of the marking.py process and its children.
+    """
+    cmd = [sys.executable, os.path.join(HERE, "marking.py"), folder,
+           "--checker", "fizzbuzz"] + cli_args
+    log_path = os.path.join(folder, "cli.log")
+    with open(log_path, "w") as log:
+        start = time.perf_counter()
+        p = subprocess.Popen(cmd, cwd=folder, stdout=log,
+                             stderr=subprocess.STDOUT)
+        _, status, rusage = os.wait4(p.pid, 0)
+        seconds = time.perf_counter() - start
+    p.returncode = os.waitstatus_to_exitcode(status)
+    if p.returncode != 0:
+        raise RuntimeError("%s failed with exit code %s, see %s."
+                           % (" ".join(cmd), p.returncode, log_path))
+
+    with open(os.path.join(folder, "run_report.json"), encoding="utf8") as f:
+        report = json.load(f)
+    marks = {_["lms_id"]: _["mark"] for _ in report["submissions"]}
+    summary = report["summary"]
+    return {"seconds": seconds,
+            "submissions_per_second": len(cohort) / seconds,
+            "submission_seconds": summary["submission_seconds"],
+            "phase_seconds": summary["phase_seconds"],
+            "slowest_runs": summary["slowest_runs"],
+            "check_cache": summary["check_cache"],
+            "peak_rss": sandbox.usage_of(rusage)["max_rss"],
+            "wrong_marks": _wrong_marks(cohort, [marks.get(lms_id, -1)
+                                                 for lms_id, _ in cohort])}
+
+
+def print_result(mode, res):
+    print("%s: %.1f submissions/s (%.2f s), peak RSS %.1f MB"
+          % (mode, res["submissions_per_second"], res["seconds"],
+             res["peak_rss"] / 2**20))
+    fmt = "    %-9s %6s %9s %9s %9s %9s"
+    print(fmt % ("phase", "count", "p50, ms", "p90, ms", "p99, ms",
+                 "max, ms"))
+    for phase, stats in sorted(res["phase_seconds"].items()):
+        print(fmt % ((phase, stats["count"]) +
+                     tuple("%.2f" % (stats[_] * 1e3)
+                           for _ in ("p50", "p90", "p99", "max"))))
+    cache = res["check_cache"]
+    if cache["hit_rate"] is not None:
+        print("    check cache: %s hits, %s misses, hit rate %.2f"
+              % (cache["hits"], cache["misses"], cache["hit_rate"]))
+    for lms_id, kind, mark in res["wrong_marks"]:
+        print("    WRONG MARK: %s (%s) got %s, expected %s."
+              % (lms_id, kind, mark, KINDS[kind][1]))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Benchmark marking a synthetic fizzbuzz cohort.")
+    parser.add_argument("-n", type=int, default=100,
+                        help="Number of submissions (default: 100).")
+    parser.add_argument("--mix", default=DEFAULT_MIX,
+                        help="Comma-separated kind=weight pairs, kinds are "
+                             "%s (default: %s)."
+                             % (", ".join(sorted(KINDS)), DEFAULT_MIX))
+    parser.add_argument("--seed", type=int, default=0,
+                        help="Seed of the cohort generator (default: 0).")
+    parser.add_argument("--mode", choices=["api", "cli", "both"],
+                        default="both",
+                        help="Mark in this process, via the CLI or both "
+                             "(default: both).")
+    parser.add_argument("--jobs", "-j", type=int, default=1,
+                        help="Number of parallel jobs (default: 1).")
+    parser.add_argument("--executor", choices=["process", "thread", "asyncio"],
+                        default="process",
+                        help="See marking.py --executor (default: process).")
+    parser.add_argument("--engine", choices=sorted(ENGINES),
+                        default="subprocess",
+                        help="See marking.py --engine (default: subprocess).")
+    parser.add_argument("--timeout", type=float, default=1,
+                        help="Timeout of each run, in seconds (default: 1).")
+    parser.add_argument("--console-level", choices=logs.LEVELS,
+                        default="critical",
+                        help="See marking.py --console-level "
+                             "(default: critical).")
+    parser.add_argument("--keep", metavar="FOLDER",
+                        help="Generate the cohort in FOLDER and keep it.")
+    parser.add_argument("--save", metavar="JSON",
+                        help="Save the results to a JSON file.")
+    parser.add_argument("--compare", metavar="JSON",
+                        help="Fail if slower than the results saved in JSON.")
+    parser.add_argument("--tolerance", type=float, default=0.2,
+                        help="Allowed relative drop of the throughput for "
+                             "--compare (default: 0.2).")
+    args = parser.parse_args()
+
+    mix = parse_mix(args.mix)
+    checker_kwds = {"timeout": args.timeout}
+    cli_args = ["--timeout", str(args.timeout), "--jobs", str(args.jobs),
+                "--executor", args.executor, "--engine", args.engine,
+                "--console-level", args.console_level]
+    logs.configure(console_level=args.console_level)
+    if args.engine != "subprocess":
+        checker_kwds["engine"] = args.engine
+
+    root = args.keep or tempfile.mkdtemp(prefix="bench_marking_")
+    results = {"n": args.n, "mix": mix, "seed": args.seed, "jobs": args.jobs,
+               "executor": args.executor, "engine": args.engine,
+               "timeout": args.timeout}
+    try:
+        modes = ["api", "cli"] if args.mode == "both" else [args.mode]
+        for mode in modes:
+            folder = os.path.join(root, mode)
+            cohort = make_cohort(folder, args.n, mix, args.seed)
+            if mode == "api":
+                res = bench_api(folder, cohort, checker_kwds, args.jobs,
+                                args.executor)
+            else:
+                res = bench_cli(folder, cohort, cli_args)
+            print_result(mode, res)
+            results[mode] = res
+    finally:
+        if args.keep is None:
+            shutil.rmtree(root, ignore_errors=True)
+
+    if args.save:
+        with open(args.save, "w", encoding="utf8") as f:
+            json.dump(results, f, indent=1)
+
+    failed = any(results[_]["wrong_marks"] for _ in modes)
+    if args.compare:
+        with open(args.compare, encoding="utf8") as f:
+            previous = json.load(f)
+        for mode in modes:
+            if mode not in previous:
+                continue
+            before = previous[mode]["submissions_per_second"]
+            now = results[mode]["submissions_per_second"]
+            if now < before * (1 - args.tolerance):
+                print("%s: REGRESSION, %.1f submissions/s, was %.1f."
+                      % (mode, now, before))
+                failed = True
+    sys.exit(1 if failed else 0)
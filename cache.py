@@ -0,0 +1,234 @@
+"""
+On-disk caches for the marking machinery.
+
+Cache entries are pickles in a cache folder, keyed by a hex digest of
+whatever determines the cached value. Writes are atomic, so that several
+marking processes can share a cache folder.
+
+The bytecode of the scripts is cached in the same way, see `CodeCache`.
+`LRUCache` is a bounded in-memory cache.
+"""
+from __future__ import division, print_function, absolute_import
+
+import os
+import hashlib
+import inspect
+import pickle
+import tempfile
+import py_compile
+import importlib.util
+import threading
+from collections import OrderedDict
+
+# The default folder for the bytecode of the scripts, one per user.
+CODE_DIR = os.path.join(tempfile.gettempdir(),
+                        "marker-bytecode-%s" % os.getuid())
+
+
+def digest(*parts):
+    """A hex digest of `parts`: bytes are hashed as is, the rest via repr."""
+    h = hashlib.sha256()
+    for part in parts:
+        if not isinstance(part, bytes):
+            part = repr(part).encode('utf8')
+        h.update(hashlib.sha256(part).digest())
+    return h.hexdigest()
+
+
+def file_digest(path):
+    """A hex digest of the file contents."""
+    with open(path, 'rb') as f:
+        return hashlib.sha256(f.read()).hexdigest()
+
+
+def source_digest(obj):
+    """A hex digest of the source code of a function, method or class.
+
+    Falls back to the qualified name if the source is not available.
+    """
+    try:
+        src = inspect.getsource(obj)
+    except (TypeError, OSError):
+        src = "%s.%s" % (getattr(obj, '__module__', None),
+                         getattr(obj, '__qualname__', repr(obj)))
+    return digest(src)
+
+
+def module_digest(obj):
+    """A hex digest of the source file of the module of a function or
+    method, and of its name there.
+
+    Unlike `source_digest`, this changes with the helpers `obj` calls in the
+    same module. Falls back to `source_digest` if there is no source file.
+    """
+    try:
+        path = inspect.getsourcefile(obj)
+    except TypeError:
+        path = None
+    if path is None or not os.path.exists(path):
+        return source_digest(obj)
+    return digest(file_digest(path), getattr(obj, '__qualname__', None))
+
+
+def private_folder(folder):
+    """Create `folder`, which only this user may write to, if needed.
+
+    Raises PermissionError if the folder is there already, but belongs to
+    another user or is writable by others: what runs from a folder should
+    not be planted there.
+    """
+    os.makedirs(folder, mode=0o700, exist_ok=True)
+    st = os.stat(folder)
+    if st.st_uid != os.getuid() or st.st_mode & 0o022:
+        raise PermissionError("%s is writable by other users." % folder)
+    return folder
+
+
+class DiskCache(object):
+    """A folder of pickles, keyed by digests.
+
+    Parameters
+    ----------
+    folder : str
+        The cache folder. It is created if needed.
+    """
+    def __init__(self, folder):
+        self.folder = os.path.abspath(folder)
+        os.makedirs(self.folder, exist_ok=True)
+
+    def _path(self, key):
+        return os.path.join(self.folder, key + '.pickle')
+
+    def get(self, key, default=None):
+        try:
+            with open(self._path(key), 'rb') as f:
+                return pickle.load(f)
+        except (OSError, EOFError, pickle.UnpicklingError):
+            return default
+
+    def set(self, key, value):
+        fd, tmp = tempfile.mkstemp(dir=self.folder, suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                pickle.dump(value, f, protocol=pickle.HIGHEST_PROTOCOL)
+            os.replace(tmp, self._path(key))
+        except Exception:
+            os.remove(tmp)
+            raise
+
+
+class ResultCache(object):
+    """Marks and logs of already marked submissions.
+
+    The results are keyed by the checker name and the fingerprint of the
+    Exercise (see `Exercise.fingerprint`), and by the digest of the
+    submission (see `Submission.digest`), so that changing the checker, or
+    any file of a submission, invalidates the cached results.
+
+    Parameters
+    ----------
+    folder : str
+        The cache folder. Results are stored in its ``results`` subfolder.
+    checker : str
+        The name of the checker.
+    exercise : Exercise
+        The exercise the submissions are marked against.
+    """
+    def __init__(self, folder, checker, exercise):
+        self._cache = DiskCache(os.path.join(folder, 'results'))
+        self._key = digest(checker, exercise.fingerprint())
+
+    def get(self, submission_digest):
+        """Return the cached ``(mark, log)`` or None."""
+        return self._cache.get(digest(self._key, submission_digest))
+
+    def set(self, submission_digest, mark, log):
+        self._cache.set(digest(self._key, submission_digest), (mark, log))
+
+
+class CodeCache(object):
+    """The bytecode of scripts, keyed by their name and contents.
+
+    A script compiles to ``<digest>.pyc``, which `launch` runs as python
+    would run the script, but without compiling it again. A script which
+    does not compile gets ``<digest>.err`` with the error instead, so that
+    it is not compiled again either. Nothing is written next to the scripts
+    themselves.
+
+    Parameters
+    ----------
+    folder : str, optional
+        The cache folder, `CODE_DIR` by default. It is created if needed,
+        private to the user, see `private_folder`.
+    """
+    def __init__(self, folder=None):
+        self.folder = private_folder(os.path.abspath(folder or CODE_DIR))
+
+    def compile(self, path):
+        """Compile the script at `path`, return the path to its bytecode.
+
+        Raises ValueError with the error message if it does not compile.
+        """
+        with open(path, 'rb') as f:
+            key = digest(importlib.util.MAGIC_NUMBER,
+                         os.path.abspath(path), f.read())
+        pyc = os.path.join(self.folder, key + '.pyc')
+        if os.path.exists(pyc):
+            return pyc
+        err = os.path.join(self.folder, key + '.err')
+        if os.path.exists(err):
+            with open(err, encoding='utf8') as f:
+                raise ValueError(f.read())
+
+        fd, tmp = tempfile.mkstemp(dir=self.folder, suffix='.tmp')
+        os.close(fd)
+        try:
+            py_compile.compile(path, cfile=tmp, doraise=True)
+            os.replace(tmp, pyc)
+        except py_compile.PyCompileError as e:
+            with open(tmp, 'w', encoding='utf8') as f:
+                f.write(e.msg)
+            os.replace(tmp, err)
+            raise ValueError(e.msg)
+        except Exception:
+            if os.path.exists(tmp):
+                os.remove(tmp)
+            raise
+        return pyc
+
+
+class LRUCache(object):
+    """An in-memory cache of at most `maxsize` entries, which drops the least
+    recently used ones. Counts the hits and the misses; safe to share between
+    threads.
+    """
+    def __init__(self, maxsize):
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self._lock:
+            try:
+                value = self._data[key]
+            except KeyError:
+                self.misses += 1
+                return default
+            self._data.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def set(self, key, value):
+        with self._lock:
+            self._data[key] = value
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def stats(self):
+        """The ``hits``, ``misses``, ``size`` and ``maxsize``, as a dict."""
+        with self._lock:
+            return {"hits": self.hits, "misses": self.misses,
+                    "size": len(self._data), "maxsize": self.maxsize}
@@ -0,0 +1,168 @@
+"""
+Check that the distributed marking survives losing a worker.
+
+Start a `distributed.Coordinator` and two local worker processes, see
+`distributed.run_worker`, and mark a small fizzbuzz cohort (after the
+patterns in `bench_marking`) with one slow submission, which goes first:
+
+* ``kill``: the worker marking the slow submission is killed mid-job, so
+  its job goes back to the queue and is marked once more, by the other
+  worker.
+* ``expire``: the lease runs out while the slow submission is marked, and
+  with a single attempt allowed, the coordinator gives up on it, and drops
+  the result which comes later.
+
+Either way, check the marks, and the `retried`, `given_up` and `dropped`
+counts of the coordinator. Exits with 1 if a check fails.
+
+Example:
+
+    $ python check_distributed.py kill expire
+"""
+from __future__ import division, print_function, absolute_import
+
+import argparse
+import os
+import shutil
+import sys
+import tempfile
+import threading
+import time
+from multiprocessing import Process
+
+import logs
+from bench_marking import KINDS
+from distributed import Coordinator, run_worker
+from LMSzip import Student
+from marking import setup_logger
+
+# scenario -> (seconds the slow submission sleeps in each of its runs, the
+# lease, max_attempts, the expected (retried, given_up, dropped) and the
+# expected mark of the slow submission)
+SCENARIOS = {
+    "kill": (1, 60, 3, (1, 0, 0), 100),
+    "expire": (1.5, 1, 1, (0, 1, 1), 0),
+}
+
+# The number of the other, fast submissions.
+NUM_FAST = 6
+
+# Seconds to wait for the slow submission to be handed out.
+LEASE_TIMEOUT = 30
+
+
+def make_cohort(folder, sleep):
+    """Write the slow submission, which sleeps `sleep` seconds in each run,
+    and `NUM_FAST` correct ones into the subfolders of `folder`.
+
+    Returns the list of ``(ppath, student)`` tasks, the slow one first.
+    """
+    correct = KINDS["correct"][0]
+    sources = [("slow", "import time\ntime.sleep(%s)\n" % sleep + correct)]
+    sources += [("student_%02d" % j, correct) for j in range(NUM_FAST)]
+    tasks = []
+    for lms_id, source in sources:
+        ppath = os.path.join(folder, lms_id)
+        os.makedirs(ppath)
+        with open(os.path.join(ppath, "fizzbuzz.py"), "w") as f:
+            f.write(source)
+        tasks.append((ppath, Student(lms_id)))
+    return tasks
+
+
+def _wait_for_lease(coordinator, ppath):
+    """Wait until the job of `ppath` is leased out, return the worker."""
+    deadline = time.monotonic() + LEASE_TIMEOUT
+    while time.monotonic() < deadline:
+        worker = coordinator.leased().get(ppath)
+        if worker is not None:
+            return worker
+        time.sleep(0.05)
+    raise RuntimeError("%s was not handed out in %s seconds."
+                       % (ppath, LEASE_TIMEOUT))
+
+
+def check(folder, scenario, logger):
+    """Run the `scenario` on a cohort in `folder`. Returns the list of the
+    failed checks."""
+    sleep, lease, max_attempts, counts, slow_mark = SCENARIOS[scenario]
+    tasks = make_cohort(folder, sleep)
+
+    authkey = os.urandom(16)
+    coordinator = Coordinator(("127.0.0.1", 0), authkey, "fizzbuzz",
+                              logger=logger, lease=lease,
+                              max_attempts=max_attempts)
+    workers = {}
+    for _ in range(2):
+        proc = Process(target=run_worker, args=(coordinator.address,
+                                                authkey))
+        proc.start()
+        workers[proc.pid] = proc
+
+    marked = []
+    thread = threading.Thread(
+        target=lambda: marked.extend(coordinator.mark(tasks)))
+    thread.start()
+    if scenario == "kill":
+        # the worker name is host:pid, see `run_worker`
+        worker = _wait_for_lease(coordinator, tasks[0][0])
+        time.sleep(sleep / 2)
+        workers[int(worker.rpartition(":")[2])].kill()
+    thread.join()
+
+    # let the workers finish, so that all the late results are in
+    coordinator.close()
+    for proc in workers.values():
+        proc.join()
+
+    failed = []
+    expected = [slow_mark] + [KINDS["correct"][1]] * NUM_FAST
+    for res, mark in zip(marked, expected):
+        if round(res["mark"]) != mark:
+            failed.append("%s got %s, expected %s."
+                          % (res["lms_id"], res["mark"], mark))
+    if marked[0].get("failed", False) != (slow_mark == 0):
+        failed.append("slow is%s flagged as failed."
+                      % ("" if marked[0].get("failed") else " not"))
+    got = (coordinator.retried, coordinator.given_up, coordinator.dropped)
+    if got != counts:
+        failed.append("(retried, given_up, dropped) = %s, expected %s."
+                      % (got, counts))
+    return failed
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Check the retries of the distributed marking.")
+    parser.add_argument("scenarios", nargs="*", metavar="SCENARIO",
+                        help="The scenarios to run, %s (default: all)."
+                             % ", ".join(sorted(SCENARIOS)))
+    parser.add_argument("--console-level", choices=logs.LEVELS,
+                        default="critical",
+                        help="See marking.py --console-level "
+                             "(default: critical).")
+    parser.add_argument("--keep", metavar="FOLDER",
+                        help="Generate the cohorts in FOLDER and keep them.")
+    args = parser.parse_args()
+    for scenario in args.scenarios:
+        if scenario not in SCENARIOS:
+            parser.error("unknown scenario %s" % scenario)
+
+    logs.configure(console_level=args.console_level)
+    root = args.keep or tempfile.mkdtemp(prefix="check_distributed_")
+    os.makedirs(root, exist_ok=True)
+    # not "root": the forked workers would log to the same file
+    logger = setup_logger("coordinator",
+                          log_file=os.path.join(root, "check.log"))
+    num_failed = 0
+    try:
+        for scenario in args.scenarios or sorted(SCENARIOS):
+            failed = check(os.path.join(root, scenario), scenario, logger)
+            print("%s: %s" % (scenario, "FAILED" if failed else "ok"))
+            for msg in failed:
+                print("    %s" % msg)
+            num_failed += len(failed)
+    finally:
+        if args.keep is None:
+            shutil.rmtree(root)
+    sys.exit(1 if num_failed else 0)
@@ -0,0 +1,90 @@
+"""
+The registry of checkers: the factories which construct the Exercises.
+
+A checker is selected by name, and its factory is given by a spec
+``"module:factory"``. The module is only imported once the checker is
+selected, so that the dependencies of one checker, e.g. numpy, do not slow
+down marking with another one.
+
+The checkers are looked up in
+
+1. `CHECKERS`, which lists the built-in ones;
+2. the ``marker.checkers`` entry points of the installed packages;
+3. the name itself, if it is a ``"module:factory"`` spec;
+4. ``shims.get_<name>``, for backwards compatibility.
+
+The factory is called with the ``logger`` and the Exercise keyword
+arguments, and returns an Exercise instance.
+"""
+from __future__ import division, print_function, absolute_import
+
+import importlib
+
+ENTRY_POINT_GROUP = "marker.checkers"
+
+# name -> "module:factory"
+CHECKERS = {
+    "fizzbuzz": "shims:get_fizzbuzz",
+    "ex1_7": "numeric:get_ex1_7",
+    "ex_q": "numeric:get_ex_q",
+}
+
+
+def register(name, spec):
+    """Register the checker `name` with the factory `spec`."""
+    if ":" not in spec:
+        raise ValueError("Expected a 'module:factory' spec, got %s." % spec)
+    CHECKERS[name] = spec
+
+
+def _entry_points():
+    """The ``{name: spec}`` of the checkers in the entry points."""
+    try:
+        from importlib.metadata import entry_points
+    except ImportError:
+        return {}
+    try:
+        eps = entry_points(group=ENTRY_POINT_GROUP)
+    except TypeError:
+        # python < 3.10
+        eps = entry_points().get(ENTRY_POINT_GROUP, [])
+    return {ep.name: ep.value for ep in eps}
+
+
+def find_spec(checker):
+    """The ``"module:factory"`` spec of the `checker`, see the module
+    docstring for the lookup order."""
+    if checker in CHECKERS:
+        return CHECKERS[checker]
+    eps = _entry_points()
+    if checker in eps:
+        return eps[checker]
+    if ":" in checker:
+        return checker
+    return "shims:get_" + checker
+
+
+def load_factory(checker):
+    """Import the factory of the `checker`. Raises ValueError if not found."""
+    spec = find_spec(checker)
+    module_name, _, attr = spec.partition(":")
+    try:
+        module = importlib.import_module(module_name)
+        factory = module
+        for name in attr.split("."):
+            factory = getattr(factory, name)
+    except (ImportError, AttributeError) as e:
+        raise ValueError("Cannot load the checker %s from %s: %s"
+                         % (checker, spec, e))
+    return factory
+
+
+def list_checkers():
+    """The sorted list of ``(name, spec)`` of the known checkers.
+
+    Nothing is imported: the entry points are only read from the package
+    metadata.
+    """
+    res = dict(_entry_points())
+    res.update(CHECKERS)
+    return sorted(res.items())
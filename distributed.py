@@ -0,0 +1,308 @@
+"""
+Marking across several machines.
+
+A `Coordinator` hands out the submission folders to the workers which
+connect to it, and collects their `mark_one_path` result dicts. The workers,
+`run_worker`, build the Exercise via the checker factory, see `checkers`,
+with the checker name and arguments they get from the coordinator. Start as
+many as there are cores on each node:
+
+    $ python marking.py ROOT --checker fizzbuzz --serve 0.0.0.0:6000
+    $ python marking.py --worker coordinator-host:6000 --jobs 8
+
+The connections are `multiprocessing.connection` ones, authenticated with a
+shared key (``--authkey`` or ``$MARKER_AUTHKEY``): the messages are pickles,
+so do not let anyone else connect. The submission folders must be at the same
+paths on all nodes, e.g. on a shared filesystem.
+
+A job of a worker which disconnects, or which does not return a result
+within the `lease`, goes back to the queue, up to `max_attempts` times. A job
+may then be marked twice; only the first result counts.
+"""
+from __future__ import division, print_function, absolute_import
+
+import os
+import time
+import socket
+import logging
+import threading
+import collections
+from multiprocessing import Process
+from multiprocessing.connection import Listener, Client, AuthenticationError
+
+import logs
+
+# Default seconds a worker has to mark a submission.
+LEASE = 600
+
+# Seconds a worker keeps trying to connect to a coordinator which is not up.
+CONNECT_TIMEOUT = 60
+
+
+def parse_address(address):
+    """Parse ``"host:port"`` into a ``(host, port)`` pair."""
+    host, _, port = address.rpartition(":")
+    if not host or not port.isdigit():
+        raise ValueError("Expected a host:port address, got %s." % address)
+    return host, int(port)
+
+
+class _Job(object):
+    def __init__(self, ppath, student, lms_id):
+        self.ppath = ppath
+        self.student = student
+        self.lms_id = lms_id
+        self.attempts = 0
+        self.worker = None      # the worker it is leased to, if any
+        self.deadline = None
+        self.result = None
+
+
+class Coordinator(object):
+    """Hand out the submissions to the workers, collect the results.
+
+    Parameters
+    ----------
+    address : tuple
+        The ``(host, port)`` to listen on.
+    authkey : bytes
+        The key the workers authenticate with.
+    checker : str
+        The name of the checker, see `checkers`.
+    checker_kwds : dict, optional
+        The keyword arguments of the checker factory.
+    logger : logging.Logger, optional
+    lease : float, optional
+        Seconds a worker has to mark a submission.
+    max_attempts : int, optional
+        The number of times to hand out a submission before giving up on it.
+
+    The workers may connect at any time, and stay connected between the
+    `mark` calls. Call `close` when done, to let them go.
+
+    The numbers of the jobs put back into the queue, of the jobs given up
+    on, and of the results dropped as duplicates are in `retried`,
+    `given_up` and `dropped`.
+    """
+    def __init__(self, address, authkey, checker, checker_kwds=None,
+                 logger=None, lease=LEASE, max_attempts=3):
+        self.checker = checker
+        self.checker_kwds = checker_kwds or {}
+        self.logger = logger or logging.getLogger(__name__)
+        self.lease = lease
+        self.max_attempts = max_attempts
+
+        self._cond = threading.Condition()
+        self._jobs = {}
+        self._queue = collections.deque()
+        self._finished = collections.deque()
+        self._next_id = 0
+        self._closed = False
+        self.retried = self.given_up = self.dropped = 0
+
+        self._listener = Listener(address, authkey=authkey)
+        self.address = self._listener.address
+        threading.Thread(target=self._accept, daemon=True).start()
+
+    def close(self):
+        with self._cond:
+            self._closed = True
+            self._cond.notify_all()
+        self._listener.close()
+
+    def leased(self):
+        """The ``{ppath: worker}`` of the jobs leased out at the moment."""
+        with self._cond:
+            return {job.ppath: job.worker for job in self._jobs.values()
+                    if job.worker is not None}
+
+    def _accept(self):
+        while not self._closed:
+            try:
+                conn = self._listener.accept()
+            except AuthenticationError as e:
+                self.logger.error("Rejected a worker: %s.", e)
+                continue
+            except (OSError, EOFError):
+                # closed, or a broken handshake
+                continue
+            threading.Thread(target=self._serve, args=(conn,),
+                             daemon=True).start()
+
+    def _serve(self, conn):
+        """Talk to a worker: send it jobs, receive the results."""
+        worker, job_id = None, None
+        try:
+            _, worker = conn.recv()
+            self.logger.info("Worker %s connected.", worker)
+            conn.send(("setup", self.checker, self.checker_kwds))
+            while True:
+                msg = conn.recv()
+                if msg[0] == "result":
+                    self._finish(msg[1], msg[2], worker)
+                job_id = self._lease(worker)
+                if job_id is None:
+                    conn.send(("done",))
+                    return
+                job = self._jobs[job_id]
+                conn.send(("job", job_id, job.ppath, job.student))
+        except (OSError, EOFError) as e:
+            self.logger.error("Lost worker %s: %r.", worker, e)
+        finally:
+            conn.close()
+            with self._cond:
+                job = self._jobs.get(job_id)
+                if job is not None and job.worker == worker:
+                    self._release(job_id, "worker %s is gone" % worker)
+
+    def _lease(self, worker):
+        """Wait for a job, lease it to `worker`. None if closed."""
+        with self._cond:
+            while not self._queue and not self._closed:
+                self._cond.wait()
+            if self._closed:
+                return None
+            job_id = self._queue.popleft()
+            job = self._jobs[job_id]
+            job.attempts += 1
+            job.worker = worker
+            job.deadline = time.monotonic() + self.lease
+            return job_id
+
+    def _release(self, job_id, reason):
+        """Put the leased job back into the queue, or give up on it.
+
+        Call with the lock held.
+        """
+        job = self._jobs[job_id]
+        job.worker = job.deadline = None
+        if job.attempts < self.max_attempts:
+            self.logger.warning("Retrying %s: %s.", job.ppath, reason)
+            self._queue.append(job_id)
+            self.retried += 1
+        else:
+            self.logger.error("Giving up on %s after %s attempts: %s.",
+                              job.ppath, job.attempts, reason)
+            self.given_up += 1
+            # as `marking.mark_one_path` would return
+            self._store(job_id, {"name": job.student.name,
+                                 "lms_id": job.lms_id,
+                                 "mark": 0,
+                                 "log": "Failed to mark: %s.\n" % reason,
+                                 "seconds": 0.0,
+                                 "phases": [],
+                                 "failed": True})
+        self._cond.notify_all()
+
+    def _store(self, job_id, res):
+        job = self._jobs[job_id]
+        job.result = res
+        job.worker = job.deadline = None
+        self._finished.append(job_id)
+        self._cond.notify_all()
+
+    def _finish(self, job_id, res, worker):
+        with self._cond:
+            job = self._jobs.get(job_id)
+            if job is None or job.result is not None:
+                # marked already, by a worker which was thought lost
+                self.logger.info("Dropped a duplicate result of job %s from "
+                                 "worker %s.", job_id, worker)
+                self.dropped += 1
+                return
+            if job_id in self._queue:
+                self._queue.remove(job_id)
+            self._store(job_id, res)
+
+    def _expire(self):
+        """Release the jobs whose leases ran out. Call with the lock held."""
+        now = time.monotonic()
+        for job_id, job in self._jobs.items():
+            if job.deadline is not None and job.deadline < now:
+                self._release(job_id, "worker %s ran out of time"
+                                      % job.worker)
+
+    def mark(self, tasks, on_result=None):
+        """Mark the ``(ppath, student)`` `tasks` on the workers.
+
+        Blocks until all are marked, and returns the list of the result
+        dicts in the order of `tasks`. ``on_result(res)`` is called in this
+        thread with each result as it comes, see `marking.mark_cohort`.
+        """
+        # the results are named as `marking.mark_one_path` names them
+        from marking import name_from_path
+
+        with self._cond:
+            ids = []
+            for ppath, student in tasks:
+                self._jobs[self._next_id] = _Job(ppath, student,
+                                                 name_from_path(ppath))
+                self._queue.append(self._next_id)
+                ids.append(self._next_id)
+                self._next_id += 1
+            self._cond.notify_all()
+
+        pending = set(ids)
+        while pending:
+            with self._cond:
+                if not self._finished:
+                    self._cond.wait(1)
+                self._expire()
+                finished = list(self._finished)
+                self._finished.clear()
+            for job_id in finished:
+                pending.discard(job_id)
+                if on_result is not None:
+                    on_result(self._jobs[job_id].result)
+
+        with self._cond:
+            return [self._jobs.pop(job_id).result for job_id in ids]
+
+
+def _connect(address, authkey, timeout):
+    deadline = time.monotonic() + timeout
+    while True:
+        try:
+            return Client(address, authkey=authkey)
+        except ConnectionRefusedError:
+            if time.monotonic() > deadline:
+                raise
+            time.sleep(0.5)
+
+
+def run_worker(address, authkey, name=None, timeout=CONNECT_TIMEOUT):
+    """Mark the submissions the coordinator at `address` hands out, until it
+    is done. Wait up to `timeout` seconds for the coordinator to start."""
+    # the pool workers of marking.py do just the same
+    import marking
+
+    if name is None:
+        name = "%s:%s" % (socket.gethostname(), os.getpid())
+    conn = _connect(address, authkey, timeout)
+    try:
+        conn.send(("hello", name))
+        _, checker, checker_kwds = conn.recv()
+        marking._init_worker(checker, checker_kwds, None, logs.settings())
+        conn.send(("ready",))
+        while True:
+            msg = conn.recv()
+            if msg[0] == "done":
+                break
+            _, job_id, ppath, student = msg
+            conn.send(("result", job_id,
+                       marking._mark_in_worker(ppath, student)))
+    except EOFError:
+        # the coordinator is gone
+        pass
+    finally:
+        conn.close()
+
+
+def run_workers(address, authkey, jobs=1):
+    """Run `jobs` worker processes, see `run_worker`, until they are done."""
+    procs = [Process(target=run_worker, args=(address, authkey))
+             for _ in range(jobs)]
+    for proc in procs:
+        proc.start()
+    for proc in procs:
+        proc.join()
@@ -0,0 +1,88 @@
+"""
+Run the cached bytecode of a student script as python would run the script.
+
+    $ python launch.py CODE SCRIPT WORKDIR [LIMIT=VALUE ...]
+
+runs the bytecode in the file CODE, compiled from the script at SCRIPT, see
+`cache.CodeCache`. The script sees its own path in ``__file__`` and
+``sys.argv[0]``, and WORKDIR, the submission folder, is ``sys.path[0]``:
+as with ``python SCRIPT``, only without compiling it again. The resource
+limits, e.g. ``cpu=10``, are set first, see `set_limits`.
+
+This is the command of each run of the ``'subprocess'`` engine, see
+`marking.Program`, so it should stay light on imports.
+"""
+from __future__ import division, print_function, absolute_import
+
+import sys
+import marshal
+import builtins
+import resource
+
+
+# Resource limits, see `set_limits`.
+LIMITS = {'cpu': resource.RLIMIT_CPU,
+          'as': resource.RLIMIT_AS,
+          'nproc': resource.RLIMIT_NPROC,}
+
+
+def set_limits(limits):
+    """Set the resource limits of this process.
+
+    `limits` is a dict with keys from LIMITS: ``'cpu'`` is the CPU time in
+    seconds, ``'as'`` the address space in bytes and ``'nproc'`` the number
+    of processes of the user.
+    """
+    for key, value in (limits or {}).items():
+        if value is not None:
+            resource.setrlimit(LIMITS[key], (value, value))
+
+
+def limit_args(limits):
+    """The ``LIMIT=VALUE`` arguments of the launcher for `limits`."""
+    return ["%s=%d" % (key, value) for key, value in (limits or {}).items()
+            if value is not None]
+
+
+def print_exception(e, path):
+    """Print the traceback of `e` raised by the script at `path`.
+
+    Like python does, hide the frames above the script: these are in the
+    machinery which ran it.
+    """
+    import traceback
+    tb = e.__traceback__
+    while tb is not None and tb.tb_frame.f_code.co_filename != path:
+        tb = tb.tb_next
+    traceback.print_exception(type(e), e, tb or e.__traceback__)
+
+
+def run_code(code_path, script, workdir):
+    """Run the bytecode at `code_path` as the script `script` in `workdir`.
+
+    Exits like ``python script`` would: with the code of a SystemExit, or
+    with 1 and the traceback if the script raised.
+    """
+    with open(code_path, 'rb') as f:
+        f.read(16)      # the header of the .pyc
+        code = marshal.load(f)
+
+    sys.argv = [script]
+    sys.path[0] = workdir
+    main = type(sys)('__main__')
+    main.__file__ = script
+    main.__builtins__ = builtins
+    sys.modules['__main__'] = main
+    try:
+        exec(code, vars(main))
+    except SystemExit:
+        raise
+    except BaseException as e:
+        print_exception(e, script)
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    set_limits({key: int(value) for key, value in
+                (_.split('=') for _ in sys.argv[4:])})
+    run_code(*sys.argv[1:4])
@@ -0,0 +1,145 @@
+"""
+Loggers of the marking runs.
+
+Each student gets a logger of its own, which writes to a log file in the
+student folder and keeps the first `max_log` characters of the log for the
+spreadsheet. The handlers are closed once the student is marked, so that a
+large cohort does not run out of file descriptors, and a record is formatted
+once for both the file and the captured log. All loggers share a single
+console handler. Use `configure` to set the verbosity of the files and of
+the console.
+
+Log with lazy formatting, ``logger.info("got %s", outp)``: the message is
+only built if a handler is going to emit it.
+"""
+from __future__ import division, print_function, absolute_import
+
+import logging
+
+FORMAT = '%(levelname)s: %(asctime)s : %(message)s'
+
+# Default cap on the captured log of a student, in characters: an Excel cell
+# holds at most 32767.
+MAX_LOG = 32000
+
+TRUNCATED = "[... log truncated after %s characters ...]\n"
+
+LEVELS = ["debug", "info", "warning", "error", "critical"]
+
+_settings = {"level": logging.INFO,
+             "console_level": logging.INFO,
+             "max_log": MAX_LOG}
+
+_console = None
+
+
+def _as_level(level):
+    if isinstance(level, str):
+        return getattr(logging, level.upper())
+    return level
+
+
+def configure(level=None, console_level=None, max_log=None):
+    """Set the level of the log files, of the console and the log capture cap.
+
+    `level` and `console_level` are either `logging` levels or their names,
+    e.g. ``"warning"``. Arguments which are None are left unchanged.
+    Applies to the loggers opened afterwards, and to the console at once.
+    """
+    if level is not None:
+        _settings["level"] = _as_level(level)
+    if console_level is not None:
+        _settings["console_level"] = _as_level(console_level)
+        console_handler().setLevel(_settings["console_level"])
+    if max_log is not None:
+        _settings["max_log"] = max_log
+
+
+def settings():
+    """The current `configure` settings, as a dict of its arguments."""
+    return dict(_settings)
+
+
+def console_handler():
+    """The console handler shared by all loggers."""
+    global _console
+    if _console is None:
+        _console = logging.StreamHandler()
+        _console.setFormatter(logging.Formatter(FORMAT))
+        _console.setLevel(_settings["console_level"])
+    return _console
+
+
+class CapturingFileHandler(logging.FileHandler):
+    """Write the log to a file, and keep its first `max_log` characters.
+
+    The file is only opened on the first record. The captured log is
+    `getvalue()`.
+    """
+    def __init__(self, filename, max_log=MAX_LOG):
+        super(CapturingFileHandler, self).__init__(filename, mode='w',
+                                                   encoding='utf8',
+                                                   delay=True)
+        self.max_log = max_log
+        self.truncated = False
+        self._parts = []
+        self._size = 0
+
+    def emit(self, record):
+        try:
+            msg = self.format(record) + self.terminator
+            if self.stream is None:
+                self.stream = self._open()
+            self.stream.write(msg)
+            # pool workers exit without closing their handlers
+            self.flush()
+        except Exception:
+            self.handleError(record)
+            return
+        self._capture(msg)
+
+    def _capture(self, msg):
+        if self.truncated:
+            return
+        room = self.max_log - self._size
+        if len(msg) > room:
+            msg = msg[:room] + TRUNCATED % self.max_log
+            self.truncated = True
+        self._parts.append(msg)
+        self._size += len(msg)
+
+    def getvalue(self):
+        return "".join(self._parts)
+
+
+def open_logger(name, log_file, registered=True):
+    """Set up a logger which logs to `log_file` and to the console.
+
+    A `registered` logger is ``logging.getLogger(name)``, and its handlers
+    from a previous call are closed. Otherwise, this is a new logger, which
+    is not kept by the `logging` module, for the per-student logs.
+
+    Returns the logger and its `CapturingFileHandler`.
+    """
+    if registered:
+        logger = logging.getLogger(name)
+        close_logger(logger)
+    else:
+        logger = logging.Logger(name)
+    logger.setLevel(min(_settings["level"], _settings["console_level"]))
+    logger.propagate = False
+
+    handler = CapturingFileHandler(log_file, _settings["max_log"])
+    handler.setLevel(_settings["level"])
+    handler.setFormatter(logging.Formatter(FORMAT))
+    logger.addHandler(handler)
+    logger.addHandler(console_handler())
+    return logger, handler
+
+
+def close_logger(logger):
+    """Detach the handlers of `logger` and close them, but the console."""
+    for handler in list(logger.handlers):
+        logger.removeHandler(handler)
+        if handler is not _console:
+            handler.close()
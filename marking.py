@@ -1,18 +1,37 @@
 from __future__ import division, print_function, absolute_import
 
-from subprocess import Popen, PIPE, STDOUT, TimeoutExpired
+from subprocess import Popen, PIPE, STDOUT, DEVNULL, TimeoutExpired
 import logging
+import locale
+import threading
+import time
+import random
 import datetime
+import json
+import ast
 import sys
 import os
 import contextlib
 import argparse
-import py_compile
-from io import StringIO
-
-import openpyxl
+import functools
+import tempfile
+from io import BytesIO, TextIOWrapper
+from concurrent.futures import (ProcessPoolExecutor, ThreadPoolExecutor,
+                                as_completed)
 
+import LMSzip
 from LMSzip import fill_cohort, Student
+import sandbox
+import launch
+import logs
+import notebook
+import checkers
+import distributed
+from report import Timings
+from results import ResultStore, STORE_NAME
+from watch import SUBMISSION_EXTENSIONS
+from cache import (CODE_DIR, CodeCache, DiskCache, LRUCache, ResultCache,
+                   digest, file_digest, module_digest, source_digest)
 
 
 @contextlib.contextmanager
@@ -32,67 +51,527 @@ def name_from_path(path):
     return tail.replace(' ', '_')
 
 
-def setup_logger(logger_name, log_file, level=logging.INFO, log_buffer=None):
-    # http://stackoverflow.com/questions/17035077/python-logging-to-multiple-log-files-from-different-classes
-    l = logging.getLogger(logger_name)
-    formatter = logging.Formatter('%(levelname)s: %(asctime)s : %(message)s')
-    fileHandler = logging.FileHandler(log_file, mode='w')
-    fileHandler.setFormatter(formatter)
-    streamHandler = logging.StreamHandler()
-    streamHandler.setFormatter(formatter)
+def setup_logger(logger_name, log_file):
+    """Set up the logger `logger_name`, logging to `log_file` and the console.
+
+    Calling this again for the same name replaces the handlers. See `logs`
+    for the verbosity settings.
+    """
+    return logs.open_logger(logger_name, log_file)[0]
+
+
+# Default cap on the captured stdout and stderr of a run, in bytes.
+MAX_OUTPUT = 2**20
+
+TRUNCATED = "\n[... output truncated after %s bytes ...]\n"
+
+# Default number of the scores of distinct outputs to keep, see `Exercise`.
+CHECK_CACHE_SIZE = 4096
+
+# Not in a cache, see `Exercise._base_output`.
+_MISSING = object()
+
+
+def _as_text(data):
+    """Decode the bytes from a child process like ``Popen(text=True)`` does."""
+    return TextIOWrapper(BytesIO(data)).read()
+
+
+def _as_bytes(text):
+    """Encode the input for a child process like ``Popen(text=True)`` does."""
+    return text.encode(locale.getpreferredencoding(False))
+
 
-    l.setLevel(level)
-    l.addHandler(fileHandler)
-    l.addHandler(streamHandler)
-    if log_buffer is not None:
-        captureHandler = logging.StreamHandler(log_buffer)
-        l.addHandler(captureHandler)
-    return l
+def _capped_text(data, max_output):
+    """Decode `data`; if it is longer than `max_output` bytes, cut it and
+    append the TRUNCATED marker."""
+    if len(data) <= max_output:
+        return _as_text(data)
+    text = TextIOWrapper(BytesIO(data[:max_output]), errors='replace').read()
+    return text + TRUNCATED % max_output
+
+
+class _CappedReader(object):
+    """Read a binary stream in a thread, keeping at most ``cap + 1`` bytes.
+
+    Past the cap, the rest of the stream is drained and thrown away, so that
+    the writer does not block, and `on_overflow` is called once.
+    """
+    def __init__(self, stream, cap, on_overflow=None):
+        self.stream = stream
+        self.cap = cap
+        self.on_overflow = on_overflow
+        self.chunks, self.size = [], 0
+        self.thread = threading.Thread(target=self._read, daemon=True)
+        self.thread.start()
+
+    def _read(self):
+        fd = self.stream.fileno()
+        while True:
+            chunk = os.read(fd, 65536)
+            if not chunk:
+                break
+            if self.size <= self.cap:
+                chunk = chunk[:self.cap + 1 - self.size]
+                self.chunks.append(chunk)
+                self.size += len(chunk)
+                if self.size > self.cap and self.on_overflow is not None:
+                    self.on_overflow()
+        self.stream.close()
+
+    def data(self):
+        return b"".join(self.chunks)
+
+
+def _feed(stream, data):
+    """Write `data` to `stream` and close it; the reader may have gone."""
+    try:
+        stream.write(data)
+    except (BrokenPipeError, OSError):
+        pass
+    finally:
+        try:
+            stream.close()
+        except (BrokenPipeError, OSError):
+            pass
 
 
 class Program(object):
-    def __init__(self, folder, fname, logger, timeout=None, *args, **kwds):
+    """Run a python script in a subprocess.
+
+    Parameters
+    ----------
+    timeout : float, optional
+        The time limit of a run, in seconds. Default is 5.
+    max_output : int, optional
+        At most this many bytes of stdout and stderr of a run are kept, the
+        rest is replaced with the TRUNCATED marker. Default is MAX_OUTPUT.
+    kill_on_overflow : bool, optional
+        Whether to kill the program as soon as the output goes over
+        `max_output`. Default is True.
+    limits : dict, optional
+        Resource limits of each run, see `launch.set_limits`.
+    script_dir : str, optional
+        The folder for the scripts extracted from notebook submissions, see
+        `notebook.notebook_script`.
+    code_dir : str, optional
+        The folder for the bytecode of the scripts, see `cache.CodeCache`.
+
+    A notebook (``.ipynb``) runs as the script of its code cells. The
+    ``'subprocess'`` engine runs the cached bytecode of the script, via
+    `launch`, with the script path in ``__file__`` and ``sys.argv[0]``.
+    Either way, the submission folder is on the python path, and the
+    bytecode of the modules it imports goes to `code_dir`, not to the
+    submission folder.
+
+    Each run is in a process group of its own, and on timeout the whole group
+    is killed. The CPU time and the peak RSS of the last run are recorded in
+    `self.usage`.
+    """
+    def __init__(self, folder, fname, logger, timeout=None, max_output=None,
+                 kill_on_overflow=True, limits=None, script_dir=None,
+                 code_dir=None, *args, **kwds):
         super(Program, self).__init__(*args, **kwds)
 
         self.workdir = os.path.abspath(folder)
         self.fname = fname
+        self.script = os.path.join(self.workdir, fname)
+        self.script_dir = script_dir
+        self.code_dir = code_dir or CODE_DIR
+        self.code = None
+        self.env = None
 
         self.timeout = timeout if timeout else 5
+        self.max_output = max_output if max_output else MAX_OUTPUT
+        self.kill_on_overflow = kill_on_overflow
+        self.limits = limits
         self.cmd = None
+        self.timed_out = False  # whether the last run timed out
+        self.usage = None       # resource usage of the last run
+
+    def digest(self):
+        """A hex digest of the program source."""
+        return file_digest(os.path.join(self.workdir, self.fname))
 
     def compile(self, logger):
         """ Compile the code. Return True/False for success status.
         """
         # XXX: refactor the python-specific part to _compile.
-        logger.info("Compiling %s ..." % self.fname)
+        logger.info("Compiling %s ...", self.fname)
 
-        self.cmd = [sys.executable, self.fname]
-        with use_folder(self.workdir):
-            try:
-                # Check if the file is valid python code.
-                py_compile.compile(os.path.join(self.workdir, self.fname),
-                                   doraise=True)
-                success = True
-            except Exception as e:
-                logger.error("Compilation failed. Exception %s " % e)
-                success = False
+        try:
+            if self.fname.endswith('.ipynb'):
+                self.script = notebook.notebook_script(
+                    os.path.join(self.workdir, self.fname), self.script_dir)
+
+            # Check if the file is valid python code.
+            self.code = CodeCache(self.code_dir).compile(self.script)
+            # the launcher sets the limits: preexec_fn is not safe with the
+            # threads of the marking process
+            self.cmd = ([sys.executable, os.path.abspath(launch.__file__),
+                         self.code, self.script, self.workdir] +
+                        launch.limit_args(self.limits))
+            self.env = dict(os.environ,
+                            PYTHONPYCACHEPREFIX=os.path.join(self.code_dir,
+                                                             'pycache'))
+            success = True
+        except Exception as e:
+            logger.error("Compilation failed. Exception %s ", e)
+            success = False
         return success
 
+    def prefetch(self, logger, inputs):
+        """Get ready to `run` the program on all of `inputs`.
+
+        This is a no-op here. Subclasses can override this to run the
+        program on all inputs at once, see `BatchProgram`.
+        """
+        pass
+
+    def _record_usage(self, usage, logger):
+        self.usage = usage
+        if usage is not None:
+            logger.info("cpu time %.3f s, peak RSS %.1f MB",
+                        usage['cpu_time'], usage['max_rss'] / 2**20)
+
+    def _wait(self, p, deadline):
+        """Wait for `p` to exit and record its resource usage. Raise
+        TimeoutExpired if it is still running by the `deadline`."""
+        delay = 0.0005
+        while True:
+            pid, status, rusage = os.wait4(p.pid, os.WNOHANG)
+            if pid != 0:
+                break
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                raise TimeoutExpired(self.cmd, self.timeout)
+            time.sleep(min(delay, remaining))
+            delay = min(2 * delay, 0.05)
+        p.returncode = os.waitstatus_to_exitcode(status)
+        return sandbox.usage_of(rusage)
+
+    def _outputs(self, out_data, err_data, logger):
+        """Decode the captured stdout and stderr, capped at max_output."""
+        for name, data in (("stdout", out_data), ("stderr", err_data)):
+            if len(data) > self.max_output:
+                logger.error("The %s is over %s bytes, truncated.",
+                             name, self.max_output)
+        return (_capped_text(out_data, self.max_output),
+                _capped_text(err_data, self.max_output))
+
     def run(self, logger, inp=None):
         """Run the program in a subprocess. Grab the output.
+
+        The subprocess runs in `self.workdir`; the working directory of the
+        marking process itself is left alone, so that several programs can
+        run concurrently.
+
+        The output is read as it comes, and only up to `self.max_output`
+        bytes of it are kept, see `_CappedReader`.
         """
-        logger.info("running %s with input %s" % (self.fname, inp))
+        logger.info("running %s with input %s", self.fname, inp)
+        inp_ = str(inp) if inp is not None else ""
+        self.timed_out, self.usage = False, None
+        deadline = time.monotonic() + self.timeout
+
+        p = Popen(self.cmd, stdin=PIPE, stdout=PIPE, stderr=PIPE,
+                  cwd=self.workdir, env=self.env, start_new_session=True)
+        kill = functools.partial(sandbox.killpg, p.pid)
+        on_overflow = kill if self.kill_on_overflow else None
+        readers = [_CappedReader(p.stdout, self.max_output, on_overflow),
+                   _CappedReader(p.stderr, self.max_output, on_overflow)]
+        threading.Thread(target=_feed, args=(p.stdin, _as_bytes(inp_)),
+                         daemon=True).start()
+
+        # like communicate(): wait for EOF on the outputs, then for the exit
+        try:
+            for reader in readers:
+                reader.thread.join(max(deadline - time.monotonic(), 0))
+                if reader.thread.is_alive():
+                    raise TimeoutExpired(self.cmd, self.timeout)
+            usage = self._wait(p, deadline)
+        except TimeoutExpired:
+            logger.error("Timed out %s seconds", self.timeout)
+            kill()
+            self._record_usage(self._wait(p, float('inf')), logger)
+            self.timed_out = True
+            return "", None
+        finally:
+            # whatever it left running in its process group
+            kill()
+        self._record_usage(usage, logger)
+        return self._outputs(readers[0].data(), readers[1].data(), logger)
+
+
+class AsyncProgram(Program):
+    """A Program which runs in an asyncio subprocess.
+
+    Use the `arun` coroutine instead of `run`. It has the same
+    ``(output, err)`` contract and timeout behavior as `Program.run`, but
+    does not block the event loop while the child process is running.
+    The child process is reaped by asyncio, so the resource usage of the
+    run is not available: `self.usage` is None.
+
+    Parameters
+    ----------
+    limit : asyncio.Semaphore, optional
+        If given, holds a slot of `limit` while the child process is alive.
+        Share a semaphore between AsyncPrograms to bound the number of child
+        processes in flight.
+    """
+    def __init__(self, folder, fname, logger, timeout=None, limit=None,
+                 *args, **kwds):
+        super(AsyncProgram, self).__init__(folder, fname, logger, timeout,
+                                           *args, **kwds)
+        self.limit = limit
+
+    async def arun(self, logger, inp=None):
+        """Run the program in an asyncio subprocess. Grab the output."""
+        if self.limit is None:
+            return await self._arun(logger, inp)
+        async with self.limit:
+            return await self._arun(logger, inp)
+
+    async def _aread(self, stream, on_overflow):
+        """Read `stream` to the end, keeping at most max_output + 1 bytes."""
+        chunks, size = [], 0
+        while True:
+            chunk = await stream.read(65536)
+            if not chunk:
+                break
+            if size <= self.max_output:
+                chunk = chunk[:self.max_output + 1 - size]
+                chunks.append(chunk)
+                size += len(chunk)
+                if size > self.max_output and on_overflow is not None:
+                    on_overflow()
+        return b"".join(chunks)
+
+    async def _arun(self, logger, inp):
+        import asyncio
+        logger.info("running %s with input %s", self.fname, inp)
         inp_ = str(inp) if inp is not None else ""
-        with use_folder(self.workdir):
+        self.timed_out = False
+        p = await asyncio.create_subprocess_exec(
+                *self.cmd, stdin=PIPE, stdout=PIPE, stderr=PIPE,
+                cwd=self.workdir, env=self.env, start_new_session=True)
+        kill = functools.partial(sandbox.killpg, p.pid)
+
+        async def feed():
             try:
-                p = Popen(self.cmd, stdin=PIPE, stdout=PIPE, stderr=PIPE,
-                          universal_newlines=True)
-                output, err = p.communicate(input=inp_, timeout=self.timeout)
+                p.stdin.write(_as_bytes(inp_))
+                await p.stdin.drain()
+            except (BrokenPipeError, ConnectionResetError):
+                pass
+            finally:
+                p.stdin.close()
+
+        on_overflow = kill if self.kill_on_overflow else None
+        try:
+            _, output, err, _ = await asyncio.wait_for(
+                    asyncio.gather(feed(),
+                                   self._aread(p.stdout, on_overflow),
+                                   self._aread(p.stderr, on_overflow),
+                                   p.wait()),
+                    timeout=self.timeout)
+        except asyncio.TimeoutError:
+            logger.error("Timed out %s seconds", self.timeout)
+            kill()
+            await p.wait()
+            self.timed_out = True
+            return "", None
+        finally:
+            kill()
+        return self._outputs(output, err, logger)
+
+
+class WarmProgram(Program):
+    """A Program which runs in a child of a pre-warmed interpreter.
+
+    Instead of starting a new interpreter for each run, the script runs in a
+    process forked from a warm server, which has already imported the
+    modules listed in `preload`, see `sandbox.WarmServer`. Each run still
+    gets a fresh process, and the timeout behavior is that of `Program.run`.
+    """
+    def __init__(self, folder, fname, logger, timeout=None, preload=(),
+                 *args, **kwds):
+        super(WarmProgram, self).__init__(folder, fname, logger, timeout,
+                                          *args, **kwds)
+        self.preload = preload
+
+    def _wait_job(self, job, out_paths):
+        """Wait for the job to finish. Return False on timeout.
+
+        Kill the job once the output files get over max_output, if
+        kill_on_overflow.
+        """
+        deadline = time.monotonic() + self.timeout
+        while not job.wait(min(0.05, max(deadline - time.monotonic(), 0))):
+            if time.monotonic() >= deadline:
+                return False
+            if (self.kill_on_overflow and
+                    any(os.path.getsize(path) > self.max_output
+                        for path in out_paths)):
+                job.kill()
+                job.wait()
+        return True
+
+    def run(self, logger, inp=None):
+        """Run the program in a forked child. Grab the output."""
+        logger.info("running %s with input %s", self.fname, inp)
+        inp_ = str(inp) if inp is not None else ""
+        self.timed_out, self.usage = False, None
+        server = sandbox.warm_server(self.preload)
+        with tempfile.TemporaryDirectory() as tmp:
+            paths = [os.path.join(tmp, _)
+                     for _ in ("stdin", "stdout", "stderr")]
+            for path in paths:
+                open(path, 'wb').close()
+            with open(paths[0], 'w') as f:
+                f.write(inp_)
+
+            job = server.submit(self.workdir, self.script, *paths,
+                                limits=self.limits)
+            finished = self._wait_job(job, paths[1:])
+            # on timeout, and whatever it left running in its process group
+            job.kill()
+            if not finished:
+                logger.error("Timed out %s seconds", self.timeout)
+                job.wait()
+            self._record_usage(job.usage, logger)
+            if not finished:
+                self.timed_out = True
+                return "", None
+
+            with open(paths[1], 'rb') as f:
+                out_data = f.read(self.max_output + 1)
+            with open(paths[2], 'rb') as f:
+                err_data = f.read(self.max_output + 1)
+        return self._outputs(out_data, err_data, logger)
+
+
+class BatchProgram(Program):
+    """A Program which runs on all inputs in a single process.
+
+    `prefetch` runs the script on all inputs in one ``sandbox.py batch``
+    child process, see `sandbox.run_batch`: each input still gets fresh
+    globals, fresh in-memory standard streams and its own timeout. `run`
+    then returns the outcome for its input. An input which was not reached
+    because the batch process died, or whose run raised an exception, is run
+    in a subprocess of its own, as in `Program.run`: so that a difference
+    of the in-memory streams from the real ones does not change the mark.
+    """
+    def __init__(self, *args, **kwds):
+        super(BatchProgram, self).__init__(*args, **kwds)
+        self._outcomes = {}
+
+    def prefetch(self, logger, inputs):
+        inps = [str(inp) if inp is not None else "" for inp in inputs]
+        logger.info("running %s on a batch of %s inputs",
+                    self.fname, len(inps))
+        self._outcomes = {}
+        with tempfile.TemporaryDirectory() as tmp:
+            inputs_path = os.path.join(tmp, "inputs.json")
+            results_path = os.path.join(tmp, "results.json")
+            with open(inputs_path, 'w', encoding='utf8') as f:
+                json.dump(inps, f)
+
+            cmd = [sys.executable, os.path.abspath(sandbox.__file__), 'batch',
+                   self.workdir, self.script, inputs_path, results_path,
+                   str(self.timeout), str(self.max_output),
+                   'stop' if self.kill_on_overflow else 'drop',
+                   json.dumps(self._batch_limits(len(inps)))]
+            p = Popen(cmd, stdin=DEVNULL, stdout=DEVNULL, stderr=DEVNULL,
+                      cwd=self.workdir, start_new_session=True)
+            killed = False
+            try:
+                p.wait(timeout=self.timeout * (len(inps) + 1))
             except TimeoutExpired:
-                logger.error("Timed out %s seconds" % self.timeout)
-                p.kill()
-                output, err = "", None
-        return output, err
+                sandbox.killpg(p.pid)
+                p.wait()
+                killed = True
+            sandbox.killpg(p.pid)
+
+            results = []
+            if os.path.exists(results_path):
+                with open(results_path, encoding='utf8') as f:
+                    results = [json.loads(line) for line in f
+                               if line.endswith('\n')]
+
+        if killed and len(results) < len(inps):
+            # the input it was stuck on
+            results.append({'output': '', 'err': None, 'timed_out': True,
+                            'usage': None})
+        for inp, res in zip(inps, results):
+            self._outcomes.setdefault(inp, []).append(res)
+
+    def _batch_limits(self, num_inputs):
+        """The resource limits of the whole batch: the CPU time limit is
+        for all inputs together."""
+        limits = dict(self.limits or {})
+        if limits.get('cpu') is not None:
+            limits['cpu'] *= num_inputs
+        return limits
+
+    def run(self, logger, inp=None):
+        """Return the prefetched output, or run the program in a subprocess."""
+        inp_ = str(inp) if inp is not None else ""
+        outcomes = self._outcomes.get(inp_)
+        res = outcomes.pop(0) if outcomes else None
+        if res is None or res.get('raised'):
+            return super(BatchProgram, self).run(logger, inp)
+
+        logger.info("batch run of %s with input %s", self.fname, inp)
+        self.timed_out = res['timed_out']
+        self._record_usage(res['usage'], logger)
+        if self.timed_out:
+            logger.error("Timed out %s seconds", self.timeout)
+            return "", None
+        return self._outputs(res['output'].encode('latin-1'),
+                             res['err'].encode('latin-1'), logger)
+
+
+# Program classes to run student submissions with, see `Exercise`.
+ENGINES = {'subprocess': Program,
+           'warm': WarmProgram,
+           'batch': BatchProgram,}
+
+
+class FailFast(object):
+    """Decide when to stop running a submission on the remaining inputs.
+
+    Parameters
+    ----------
+    max_timeouts : int, optional
+        Stop after this many consecutive timeouts.
+    max_repeated_errors : int, optional
+        Stop after the same stderr output repeats this many times in a row.
+
+    By default, never stop.
+    """
+    def __init__(self, max_timeouts=None, max_repeated_errors=None):
+        self.max_timeouts = max_timeouts
+        self.max_repeated_errors = max_repeated_errors
+        self._timeouts = 0
+        self._errors = 0
+        self._last_err = None
+
+    def record(self, timed_out, err):
+        """Record the outcome of a run. Return the reason to stop, or None."""
+        self._timeouts = self._timeouts + 1 if timed_out else 0
+        if err and err == self._last_err:
+            self._errors += 1
+        else:
+            self._errors = 1 if err else 0
+        self._last_err = err
+
+        if (self.max_timeouts is not None and
+                self._timeouts >= self.max_timeouts):
+            return "%s consecutive timeouts" % self._timeouts
+        if (self.max_repeated_errors is not None and
+                self._errors >= self.max_repeated_errors):
+            return "the same error %s times in a row" % self._errors
+        return None
 
 
 class FakeProgram(object):
@@ -101,11 +580,16 @@ class FakeProgram(object):
         self.func = func
         self.timeout = timeout
 
+    def digest(self):
+        """A hex digest of the source file of `func`, see
+        `cache.module_digest`."""
+        return module_digest(self.func)
+
     def compile(self, logger):
         return True
 
     def run(self, logger, inp=None):
-        logger.debug("calling %s with input %s" % (self.func, inp))
+        logger.debug("calling %s with input %s", self.func, inp)
         if inp is None:
             inp = {}
         try:
@@ -132,19 +616,94 @@ class Submission(object):
             raise ValueError("Expect a directory, got %s." % folder)
         self.folder = os.path.abspath(folder)
 
-        # find the exectutable
-        self.fname = None
-        for f in os.listdir(self.folder):
-            if self._is_executable(f):
-                self.fname = f
-                break
-        else:
+        # find the exectutable: a script, else a notebook
+        found = sorted((self._is_executable(f), f)
+                       for f in os.listdir(self.folder)
+                       if os.path.isfile(os.path.join(self.folder, f)))
+        found = [f for rank, f in found if rank]
+        if not found:
             # did not find it
             raise ValueError("Failed to find an executable in %s." % folder)
+        self.fname = found[0]
 
     def _is_executable(self, f):
-        """Replace for non-python executables."""
-        return f.endswith('.py')
+        """Replace for non-python executables.
+
+        Returns the rank of `f`, the lower the better, or 0 if it is not an
+        executable at all.
+        """
+        if f.endswith('.py'):
+            return 1
+        if f.endswith('.ipynb'):
+            return 2
+        return 0
+
+    def files(self):
+        """The sorted names of the python files and notebooks in the folder.
+
+        These are the code of the submission: the executable and the modules
+        it may import. They are also the files that watch mode watches, see
+        `watch.folder_signature`.
+        """
+        return sorted(f for f in os.listdir(self.folder)
+                      if f.endswith(SUBMISSION_EXTENSIONS) and
+                      os.path.isfile(os.path.join(self.folder, f)))
+
+    def digest(self):
+        """A hex digest of the contents of the files of the submission, see
+        `files`, and of which one is the executable."""
+        parts = [(f, file_digest(os.path.join(self.folder, f)))
+                 for f in self.files()]
+        return digest(self.fname, *parts)
+
+    def fingerprint(self):
+        """A hex digest of the code, up to the formatting and the comments.
+
+        Submissions with the same fingerprint run the same code: their
+        executables, and the other files in their folders, see `files`, parse
+        to the same syntax trees.
+        """
+        parts = []
+        for f in self.files():
+            if f == self.fname:
+                parts.append((None, os.path.splitext(f)[1],
+                              _code_digest(os.path.join(self.folder, f))))
+            else:
+                parts.append((f, _code_digest(os.path.join(self.folder, f))))
+        return digest(*parts)
+
+
+def _code_digest(path):
+    """A digest of the syntax tree of the script or notebook at `path`, or
+    of its contents if it does not parse."""
+    try:
+        if path.endswith('.ipynb'):
+            source = notebook.extract_code(path)
+        else:
+            with open(path, 'rb') as f:
+                source = f.read()
+        return digest(ast.dump(ast.parse(source)))
+    except (SyntaxError, ValueError, UnicodeDecodeError):
+        return file_digest(path)
+
+
+class _ScoreNotes(logging.LoggerAdapter):
+    """Log to `logger`, and keep the errors about each input.
+
+    The errors logged with ``extra={"inputs": [...]}`` are kept in
+    ``self.notes``, ``{input index: [message, ...]}``, see
+    `Exercise._score_cached`.
+    """
+    def __init__(self, logger):
+        super(_ScoreNotes, self).__init__(logger, {})
+        self.notes = {}
+
+    def log(self, level, msg, *args, **kwds):
+        if level >= logging.ERROR:
+            for j in kwds.get("extra", {}).get("inputs", ()):
+                self.notes.setdefault(j, []).append(msg % args if args
+                                                    else msg)
+        self.logger.log(level, msg, *args, **kwds)
 
 
 class Exercise(object):
@@ -166,12 +725,59 @@ class Exercise(object):
 
     To mark an Exercise use the `mark` method which returns the numeric mark.
 
+    The output of the `base_program` for each input is computed once, on first
+    use, and is reused for all submissions. If `cache_dir` is given, these
+    reference outputs are also saved on disk, one per input, keyed by the
+    digest of the `base_program` and the input, so that subsequent runs do
+    not need to run the `base_program` at all. The scripts extracted from notebook
+    submissions are kept there, too, see `notebook.notebook_script`.
+
+    The submissions are run by the `engine`, which is a key of `ENGINES`:
+    either a new interpreter for each input (``'subprocess'``, the default),
+    a child of a warm interpreter which has imported the `preload` modules
+    (``'warm'``, see `WarmProgram`), or a single process for all inputs
+    (``'batch'``, see `BatchProgram`). The `amark` coroutine always uses
+    an `AsyncProgram`.
+
+    A submission which keeps timing out or crashing in the same way is not run
+    on the remaining inputs, and gets zero marks for them, once there were
+    `max_timeouts` consecutive timeouts, or the same stderr output
+    `max_repeated_errors` times in a row, see `FailFast`. By default, all
+    inputs are always run.
+
+    At most `max_output` bytes of the stdout and stderr of each run are kept,
+    and a run is killed as soon as it goes over, unless `kill_on_overflow`
+    is False. Each run is subject to the resource `limits`. See `Program`.
+
+    Besides the fixed `inputs`, an Exercise can check `n_inputs` random ones,
+    drawn by ``input_generator(rng)`` from a `random.Random` seeded with
+    `seed`. Unless `weights` are given, the tasks weigh the same. The
+    reference outputs of the random inputs are cached as the others are.
+
+    Most submissions produce one of a few distinct outputs for each input.
+    The score of an output is kept in an LRU cache of `check_cache_size`
+    entries, keyed by the input and the digest of the output, so that
+    `_parse_output` and `_check` only see the outputs which were not seen
+    before. This assumes that the checks are deterministic; set
+    `check_cache_size` to 0 if they are not.
+
     """
+    # The methods which turn the outputs into the marks, and the attributes
+    # they depend on, see `fingerprint`. Subclasses add their own.
+    _scoring_methods = ("_prepare_input", "_parse_output", "_check",
+                        "_score", "_score_all", "_tally")
+    _scoring_params = ()
+
     def __init__(self, base_program, logger, timeout=None,
-                 weights=None, inputs=None, *args, **kwds):
+                 weights=None, inputs=None, cache_dir=None,
+                 engine='subprocess', preload=(), max_timeouts=None,
+                 max_repeated_errors=None, max_output=None,
+                 kill_on_overflow=True, limits=None, input_generator=None,
+                 n_inputs=None, seed=0, check_cache_size=CHECK_CACHE_SIZE,
+                 *args, **kwds):
         super(Exercise, self).__init__(*args, **kwds)
 
-        logger.info('Setting up exercise with base_program %s' % base_program)
+        logger.info('Setting up exercise with base_program %s', base_program)
 
         if callable(base_program):
             self.base_program = FakeProgram(base_program, timeout)
@@ -187,9 +793,51 @@ class Exercise(object):
         if not s:
             raise ValueError("%s compile error" % self.base_program)
 
+        if engine not in ENGINES:
+            raise ValueError("Unknown engine %s." % engine)
+        self.program_class = ENGINES[engine]
+        self.engine_kwds = {'preload': preload} if engine == 'warm' else {}
+        self.program_kwds = {'max_output': max_output,
+                             'kill_on_overflow': kill_on_overflow,
+                             'limits': limits}
+        if cache_dir is not None:
+            self.program_kwds['script_dir'] = os.path.join(cache_dir,
+                                                           'notebooks')
+            self.program_kwds['code_dir'] = os.path.join(cache_dir,
+                                                         'bytecode')
+        # fail now, rather than on each submission, if the code cache is not
+        # safe to run from
+        CodeCache(self.program_kwds.get('code_dir'))
+        self.max_timeouts = max_timeouts
+        self.max_repeated_errors = max_repeated_errors
+        self.check_cache = None
+        if check_cache_size:
+            self.check_cache = LRUCache(check_cache_size)
+
+        inputs = self._generate_inputs(inputs, input_generator, n_inputs,
+                                       seed, logger)
         self._set_up_weights(inputs, weights, logger)
+        self._set_up_reference(cache_dir, logger)
         logger.info('Done setting up the exercise.')
 
+    def _generate_inputs(self, inputs, input_generator, n_inputs, seed,
+                         logger):
+        """Append `n_inputs` random inputs to the fixed `inputs`.
+
+        Each one is ``input_generator(rng)``, where `rng` is a
+        `random.Random` seeded with `seed`, so that all submissions get the
+        same inputs, and a rerun gets them again.
+        """
+        if not n_inputs:
+            return inputs
+        if input_generator is None:
+            raise ValueError("Need an input_generator for n_inputs = %s."
+                             % n_inputs)
+        rng = random.Random(seed)
+        generated = [input_generator(rng) for _ in range(n_inputs)]
+        logger.info('Generated %s inputs with seed %s.', n_inputs, seed)
+        return list(inputs or []) + generated
+
     def _set_up_weights(self, inputs, weights, logger):
         if inputs is None:
             inputs = [None]
@@ -201,6 +849,68 @@ class Exercise(object):
             raise ValueError(mesg)
         self.weights, self.inputs = weights, inputs
 
+    def fingerprint(self):
+        """A hex digest of everything which determines the marks.
+
+        This covers the inputs and weights, the base_program, the settings
+        of the runs, the `_scoring_methods` of all classes the exercise
+        inherits from, and the `_scoring_params` attributes.
+        """
+        # the output caps and the limits do change the marks; the cache
+        # folders do not
+        run_kwds = {key: value for key, value in self.program_kwds.items()
+                    if key not in ('script_dir', 'code_dir')}
+        methods = [source_digest(vars(cls)[name])
+                   for cls in type(self).__mro__
+                   for name in self._scoring_methods if name in vars(cls)]
+        params = [(name, getattr(self, name))
+                  for name in self._scoring_params]
+        return digest(type(self).__name__, self.base_program.digest(),
+                      self.inputs, self.weights, self.timeout,
+                      self.max_timeouts, self.max_repeated_errors,
+                      run_kwds, params, *methods)
+
+    def _set_up_reference(self, cache_dir, logger):
+        # reference outputs of the base_program, {repr(input): output}
+        self._reference = {}
+        self._reference_cache = self._reference_key = None
+        if cache_dir is not None:
+            # an entry per input, so that adding one does not rewrite the rest
+            self._reference_cache = DiskCache(os.path.join(cache_dir,
+                                                           'reference'))
+            self._reference_key = self.base_program.digest()
+
+    def _base_output(self, inp, logger, timings):
+        """Return the output of the base_program for the input `inp`.
+
+        The base_program only runs the first time an input is seen, here or
+        in the reference cache.
+        """
+        key = repr(inp)
+        try:
+            return self._reference[key]
+        except KeyError:
+            pass
+
+        cache_key = None
+        if self._reference_cache is not None:
+            cache_key = digest(self._reference_key, key)
+            cached = self._reference_cache.get(cache_key, _MISSING)
+            if cached is not _MISSING:
+                self._reference[key] = cached
+                return cached
+
+        with timings.timed("base"):
+            base_outp, base_err = self.base_program.run(logger, inp)
+        if base_err:
+            logger.error("base_stderr is %s ", base_err)
+            raise ValueError("base_err is %s for input %s " % (inp, base_err))
+
+        self._reference[key] = base_outp
+        if cache_key is not None:
+            self._reference_cache.set(cache_key, base_outp)
+        return base_outp
+
     def _check(self, inp, outp, base_outp, this_logger):
         """Compare the outputs given input, return the score out of 100.
 
@@ -225,8 +935,15 @@ class Exercise(object):
         """Prepare input for self.run (e.g. command line input)."""
         return str(inp)
 
-    def mark(self, folder, logger, timeout=None):
-        logger.info("*** Marking %s ***" % folder)
+    def _compile_submission(self, folder, logger, timeout, timings,
+                            program_class=Program, **kwds):
+        """Find the submission in `folder` and compile it.
+
+        Returns a tuple ``(program, mark)`` of a `program_class` instance and
+        the mark for compilation. If there is nothing to run, `program` is
+        None.
+        """
+        logger.info("*** Marking %s ***", folder)
 
         if timeout is None:
             timeout = self.timeout
@@ -235,106 +952,811 @@ class Exercise(object):
             submission = Submission(folder)
         except ValueError:
             # failed to find an executable
-            logger.error("Failed to find an executable in %s." % folder)
-            return 0
+            logger.error("Failed to find an executable in %s.", folder)
+            return None, 0
 
-        program = Program(submission.folder, submission.fname, logger, timeout)
+        program = program_class(submission.folder, submission.fname, logger,
+                                timeout, **kwds)
 
-        with use_folder(submission.folder):
-            # start marking
-            mark = 0
+        # start marking
+        mark = 0
 
-            # compile
+        # compile
+        with timings.timed("compile"):
             success = program.compile(logger)
-            if success:
-                mark = self.weights[0]
-            else:
-                logger.info("Compilation failed, done marking. Mark = %s." % mark)
-                return mark
-            logger.info("Compilation success, mark = %s." % mark)
-                    
-            for inp, weight in zip(self.inputs, self.weights[1:]):
-                logger.info("Checking input = %s" % inp)
-                inp_ = self._prepare_input(inp)
-
-                outp, err = program.run(logger, inp_)
-                if err:
-                    logger.error("stderr is \n===\n%s\n===\n" % err)
-                    continue
-                logger.info("Received output: %s." % outp)
+        if success:
+            mark = self.weights[0]
+        else:
+            logger.info("Compilation failed, done marking. Mark = %s.", mark)
+            return None, mark
+        logger.info("Compilation success, mark = %s.", mark)
+        return program, mark
 
-                base_outp, base_err = self.base_program.run(logger, inp)
-                if base_err and not err:
-                    logger.error("base_stderr is %s " % base_err)
-                    raise ValueError("base_err is %s for input %s " % (inp, base_err))
+    def _score(self, inp, outp, err, logger, timings, j=None):
+        """Score the output `outp` of a task with input `inp` out of 100.
 
-                # check/compare outp and base_outp
+        `j` is the index of the input, for the timings and the log.
+        """
+        if err:
+            logger.error("stderr is \n===\n%s\n===\n", err)
+            return 0
+        logger.info("Received output for input %s: %s.", inp, outp)
+
+        base_outp = self._base_output(inp, logger, timings)
+
+        # check/compare outp and base_outp
+        result = 0
+        outp_ = None
+        try:
+            with timings.timed("parse", input=j):
+                outp_ = self._parse_output(inp, outp, logger)
+        except Exception as e:
+            result = 0
+            logger.error("Failed to parse the output: \n===\n %s\n===\n"
+                         "Exception: %s ", outp, e, extra={"inputs": [j]})
+
+        if outp_:
+            try:     
+                with timings.timed("check", input=j):
+                    result = self._check(inp, outp_, base_outp, logger)
+            except Exception as e:
                 result = 0
-                outp_ = None
-                try:
-                    outp_ = self._parse_output(inp, outp, logger)
-                except Exception as e:
-                    result = 0
-                    mesg = "Failed to parse the output: \n===\n %s\n===\n" % outp
-                    mesg += "Exception: %s " % e
-                    logger.error(mesg)
-
-                if outp_:
-                    try:     
-                        result = self._check(inp, outp_, base_outp, logger)
-                    except Exception as e:
-                        result = 0
-                        logger.error("Checking raised:  %s." % e)
-
-                mark += result * weight / 100
-                logger.info("result is %s, mark is %s out of %s." % (result,
-                            mark, sum(self.weights)))
-        logger.info("Done marking: %s out of %s" % (mark, sum(self.weights)))
+                logger.error("Checking raised:  %s.", e,
+                             extra={"inputs": [j]})
+        return result
+
+    def _score_all(self, inps, outps, errs, logger, timings, indices=None):
+        """Score the outputs of all runs of a submission, out of 100 each.
+
+        `indices` are those of the inputs `inps` in `self.inputs`, all of
+        them by default. The errors about the outputs are logged with the
+        indices of their inputs in ``extra={"inputs": [...]}``, see
+        `_ScoreNotes`.
+
+        By default, each output is scored on its own by `_score`. Override
+        this to check all outputs at once, e.g. `shims.NumericExercise`.
+        """
+        if indices is None:
+            indices = range(len(inps))
+        return [self._score(inp, outp, err, logger, timings, j)
+                for j, inp, outp, err in zip(indices, inps, outps, errs)]
+
+    def _score_cached(self, inps, outps, errs, logger, timings):
+        """Score the outputs via `_score_all`, but look up the scores of the
+        outputs seen before in `self.check_cache`.
+
+        The cache keeps the errors logged about an output along with its
+        score, and these are logged again on a hit.
+        """
+        if self.check_cache is None:
+            return self._score_all(inps, outps, errs, logger, timings)
+
+        results, keys = [None] * len(inps), [None] * len(inps)
+        with timings.timed("lookup") as entry:
+            for j, (inp, outp, err) in enumerate(zip(inps, outps, errs)):
+                if err:
+                    continue
+                keys[j] = (repr(inp), digest(outp))
+                cached = self.check_cache.get(keys[j])
+                if cached is not None:
+                    logger.info("Received output for input %s: %s, seen "
+                                "before.", inp, outp)
+                    results[j], notes = cached
+                    for note in notes:
+                        logger.error("%s", note)
+            entry["hits"] = sum(_ is not None for _ in results)
+            entry["misses"] = sum(_ is not None for _ in keys) - entry["hits"]
+
+        todo = [j for j, result in enumerate(results) if result is None]
+        notes = _ScoreNotes(logger)
+        scored = self._score_all([inps[j] for j in todo],
+                                 [outps[j] for j in todo],
+                                 [errs[j] for j in todo], notes, timings,
+                                 indices=todo)
+        for j, result in zip(todo, scored):
+            results[j] = result
+            if keys[j] is not None:
+                self.check_cache.set(keys[j],
+                                     (result, tuple(notes.notes.get(j, ()))))
+        return results
+
+    def _tally(self, runs, mark, logger, timings):
+        """Score the ``(inp, outp, err)`` `runs`, add them to `mark`.
+
+        Inputs which were not run, see `_fail_fast`, score zero.
+        """
+        inps, outps, errs = zip(*runs) if runs else ((), (), ())
+        results = self._score_cached(inps, outps, errs, logger, timings)
+        for inp, result, weight in zip(inps, results, self.weights[1:]):
+            mark += result * weight / 100
+            logger.info("input %s: result is %s, mark is %s out of %s.", inp,
+                        result, mark, sum(self.weights))
+        logger.info("Done marking: %s out of %s", mark, sum(self.weights))
         return mark
 
+    def _fail_fast(self, fail_fast, program, err, j, logger):
+        """Record the outcome of the run on the j-th input. Return True to
+        skip the remaining inputs."""
+        reason = fail_fast.record(program.timed_out, err)
+        num_left = len(self.inputs) - j - 1
+        if reason is None or num_left == 0:
+            return False
+        logger.warning("Got %s: skipping the remaining %s inputs, "
+                       "with zero marks for them.", reason, num_left)
+        return True
+
+    def _prepare(self, folder, logger, timeout, timings, program_class,
+                 **kwds):
+        """Compile the submission in `folder` and get it ready to run.
+
+        Returns a tuple ``(program, mark, prepared)`` of the `program_class`
+        instance, the mark for compilation and the prepared inputs. If there
+        is nothing to run, `program` is None.
+        """
+        program, mark = self._compile_submission(folder, logger, timeout,
+                                                 timings, program_class,
+                                                 **kwds)
+        if program is None:
+            return None, mark, None
+
+        prepared = [self._prepare_input(inp) for inp in self.inputs]
+        with timings.timed("prefetch"):
+            program.prefetch(logger, prepared)
+        return program, mark, prepared
+
+    def _run_inputs(self, program, prepared, logger, timings):
+        """Run `program` on the inputs, see `_fail_fast`.
+
+        This is a generator, so that `mark` and `amark` share it: it yields
+        each prepared input, and is sent back the ``(outp, err)`` of running
+        the program on it. It returns the list of the ``(inp, outp, err)``
+        runs, see `_tally`.
+        """
+        fail_fast = FailFast(self.max_timeouts, self.max_repeated_errors)
+        runs = []
+        for j, inp in enumerate(self.inputs):
+            logger.info("Checking input = %s", inp)
+            with timings.timed("run", input=j) as entry:
+                outp, err = yield prepared[j]
+            entry.update(program.usage or {}, timed_out=program.timed_out)
+
+            runs.append((inp, outp, err))
+
+            if self._fail_fast(fail_fast, program, err, j, logger):
+                break
+        return runs
+
+    def mark(self, folder, logger, timeout=None, timings=None):
+        """Mark the submission in `folder`, return the mark.
+
+        If `timings` (a `report.Timings` instance) is given, the timings of
+        the marking phases are recorded there.
+        """
+        if timings is None:
+            timings = Timings()
+        program, mark, prepared = self._prepare(
+            folder, logger, timeout, timings, self.program_class,
+            **dict(self.engine_kwds, **self.program_kwds))
+        if program is None:
+            return mark
+
+        runs = self._run_inputs(program, prepared, logger, timings)
+        try:
+            inp = next(runs)
+            while True:
+                inp = runs.send(program.run(logger, inp))
+        except StopIteration as e:
+            return self._tally(e.value, mark, logger, timings)
+
+    async def amark(self, folder, logger, timeout=None, limit=None,
+                    timings=None):
+        """A coroutine version of `mark`, which runs the submission in
+        asyncio subprocesses.
+
+        The inputs of a single submission are run one after another;
+        await many `amark` calls at once to mark many submissions
+        concurrently. `limit` is an optional asyncio.Semaphore to bound the
+        number of child processes in flight, see `AsyncProgram`.
+        """
+        if timings is None:
+            timings = Timings()
+        program, mark, prepared = self._prepare(
+            folder, logger, timeout, timings, AsyncProgram, limit=limit,
+            **self.program_kwds)
+        if program is None:
+            return mark
+
+        runs = self._run_inputs(program, prepared, logger, timings)
+        try:
+            inp = next(runs)
+            while True:
+                inp = runs.send(await program.arun(logger, inp))
+        except StopIteration as e:
+            return self._tally(e.value, mark, logger, timings)
+
     def grade(self, *args, **kwds):
         """An alias for `mark`."""
         return self.mark(*args, **kwds)
 
 
-def mark_one_path(mark_func, ppath, student, root_logger):
+def _open_student_log(ppath):
+    """Set up the per-student logger. Return the lms_id, logger and handler.
 
-    # first of all, set up the per-student logger
+    The captured log is ``handler.getvalue()``; close the logger with
+    `logs.close_logger` when done.
+    """
     name = name_from_path(ppath)
+    this_logger, handler = logs.open_logger(
+        name, os.path.join(ppath, name + '.log'), registered=False)
+    return name, this_logger, handler
+
+
+def _student_result(student, name, mark, log, seconds=0.0, phases=()):
+    return {"name": student.name,
+            "lms_id": name,
+            "mark": mark,
+            "log": log,
+            "seconds": seconds,
+            "phases": list(phases),}
+
+
+def _submission_digest(ppath):
+    """The digest of the submission at `ppath`, or None if there is none.
+
+    This keys the results of the submission in the `cache.ResultCache` and
+    in the `results.ResultStore`, see `Submission.digest`.
+    """
+    try:
+        return Submission(ppath).digest()
+    except (ValueError, OSError):
+        return None
+
 
-    log_buf = StringIO()
-    this_logger = setup_logger(logger_name=name,
-                               log_file=os.path.join(ppath, name + '.log'),
-                               level=logging.INFO,
-                               log_buffer=log_buf)
+def _lookup_result(result_cache, ppath, student, root_logger):
+    """Look up the submission at `ppath` in the `result_cache`.
 
-    root_logger.info("Marking.. %s." % ppath)
+    Return a pair of the submission digest (None if there is nothing to
+    cache), and the cached result dict (None for a cache miss).
+    """
+    if result_cache is None:
+        return None, None
+    submission_digest = _submission_digest(ppath)
+    if submission_digest is None:
+        # no executable, nothing to cache
+        return None, None
+
+    cached = result_cache.get(submission_digest)
+    if cached is None:
+        return submission_digest, None
+    mark, log = cached
+    root_logger.info("Unchanged %s; cached mark = %s.", ppath, mark)
+    return submission_digest, _student_result(student, name_from_path(ppath),
+                                              mark, log)
+
+
+class _Marking(object):
+    """The bookkeeping of marking the submission at `ppath`, which
+    `mark_one_path` and `amark_one_path` share.
+
+    If the `result_cache` has the result, it is in `cached`. Otherwise, the
+    per-student `logger` is open, and `result` builds the result dict once
+    the submission is marked.
+    """
+    def __init__(self, ppath, student, root_logger, result_cache):
+        self.start = time.perf_counter()
+        self.ppath, self.student = ppath, student
+        self.root_logger = root_logger
+        self.result_cache = result_cache
+        self.raised = False
+        self.submission_digest, self.cached = _lookup_result(
+            result_cache, ppath, student, root_logger)
+        if self.cached is not None:
+            self.cached.update(seconds=time.perf_counter() - self.start,
+                               cached=True)
+            return
+
+        # first of all, set up the per-student logger
+        self.name, self.logger, self.handler = _open_student_log(ppath)
+        root_logger.info("Marking.. %s.", ppath)
+        self.timings = Timings()
+
+    def failed(self, e):
+        """Log the exception `e` which marking raised; return the mark."""
+        self.root_logger.error("Unknown exception: %s.", e)
+        self.submission_digest = None
+        self.raised = True
+        return 0
+
+    def result(self, mark):
+        """Cache and return the result dict."""
+        self.root_logger.info("Done %s; mark = %s.", self.ppath, mark)
+        log = self.handler.getvalue()
+        if self.submission_digest is not None:
+            self.result_cache.set(self.submission_digest, mark, log)
+        res = _student_result(self.student, self.name, mark, log,
+                              time.perf_counter() - self.start,
+                              self.timings.phases)
+        if self.raised:
+            res["failed"] = True
+        return res
+
+
+def mark_one_path(mark_func, ppath, student, root_logger, result_cache=None):
+    """Mark the submission at `ppath`, return the result dict.
+
+    The mark is ``mark_func(ppath, logger, timings=timings)``, see
+    `Exercise.mark`. The result dict has the ``name``, ``lms_id``, ``mark``
+    and ``log`` of the student, and the total time of marking in ``seconds``
+    and its per-phase timings in ``phases``, see `report.Timings`.
+
+    If marking raised, the mark is 0 and the result dict also has
+    ``"failed": True``; such results are not cached.
+
+    If `result_cache` (a `cache.ResultCache`) is given, unchanged submissions
+    are not marked again, and the cached mark and log are returned instead.
+    """
+    marking = _Marking(ppath, student, root_logger, result_cache)
+    if marking.cached is not None:
+        return marking.cached
     try:
-        mark = mark_func(ppath, this_logger)
+        mark = mark_func(ppath, marking.logger, timings=marking.timings)
     except Exception as e:
-        root_logger.error("Unknown exception: %s." % e)
-        mark = 0
+        mark = marking.failed(e)
+    finally:
+        logs.close_logger(marking.logger)
+    return marking.result(mark)
+
+
+async def amark_one_path(amark_func, ppath, student, root_logger,
+                         result_cache=None):
+    """A coroutine version of `mark_one_path` for an `Exercise.amark`-like
+    coroutine function `amark_func`."""
+    marking = _Marking(ppath, student, root_logger, result_cache)
+    if marking.cached is not None:
+        return marking.cached
+    try:
+        mark = await amark_func(ppath, marking.logger,
+                                timings=marking.timings)
+    except Exception as e:
+        mark = marking.failed(e)
+    finally:
+        logs.close_logger(marking.logger)
+    return marking.result(mark)
+
+
+def get_exercise(checker, logger, **kwds):
+    """Construct the Exercise for `checker`, see `checkers.find_spec`.
+
+    Keyword arguments are passed through to the factory.
+    """
+    factory = checkers.load_factory(checker)
+    return factory(logger=logger, **kwds)
+
 
-    root_logger.info("Done %s; mark = %s." % (ppath, mark))
-    dct = {"name": student.name,
-           "lms_id": name,
-           "mark": mark,
-           "log": log_buf.getvalue(),}
-    log_buf.close()
-    return dct
+# Per-process state of the worker pool, see `mark_cohort`.
+_worker_exercise = None
+_worker_logger = None
+_worker_result_cache = None
+
+
+def _init_worker(checker, checker_kwds, result_cache, log_settings):
+    """Set up a pool worker: build its own copy of the Exercise."""
+    global _worker_exercise, _worker_logger, _worker_result_cache
+    logs.configure(**log_settings)
+    _worker_logger = logging.getLogger('root')
+    if not _worker_logger.handlers:
+        # not forked from the main process: log to stderr only
+        _worker_logger.setLevel(log_settings["console_level"])
+        _worker_logger.addHandler(logs.console_handler())
+    _worker_exercise = get_exercise(checker, _worker_logger, **checker_kwds)
+    _worker_result_cache = result_cache
+
+
+def _mark_in_worker(ppath, student):
+    return mark_one_path(_worker_exercise.mark, ppath, student, _worker_logger,
+                         _worker_result_cache)
+
+
+async def _amark_cohort(ex, tasks, root_logger, jobs, result_cache,
+                        on_result):
+    import asyncio
+    if ex.program_class is not Program:
+        root_logger.warning("The asyncio executor runs submissions with "
+                            "AsyncProgram, not %s.",
+                            ex.program_class.__name__)
+    amark_func = functools.partial(ex.amark, limit=asyncio.Semaphore(jobs))
+
+    async def amark(ppath, student):
+        res = await amark_one_path(amark_func, ppath, student, root_logger,
+                                   result_cache)
+        on_result(res)
+        return res
+
+    return await asyncio.gather(*[amark(ppath, student)
+                                  for ppath, student in tasks])
+
+
+def _ignore(res):
+    pass
+
+
+# Compile errors are logged to the per-student logs when marking.
+_compile_logger = logging.Logger('compile')
+_compile_logger.addHandler(logging.NullHandler())
+
+
+def _compile_one(ppath, program_kwds):
+    """Compile the submission at `ppath` into the caches. Return whether it
+    compiles, or None if there is no submission."""
+    try:
+        submission = Submission(ppath)
+    except ValueError:
+        return None
+    program = Program(submission.folder, submission.fname, _compile_logger,
+                      **program_kwds)
+    return program.compile(_compile_logger)
+
+
+def compile_cohort(ex, tasks, root_logger, pool=None):
+    """Compile the submissions of the ``(ppath, student)`` `tasks` in one
+    pass, before any of them runs.
+
+    The bytecode and the compile errors go to the code cache, see
+    `cache.CodeCache`, where marking then finds them: a submission is not
+    compiled again, and one which does not compile is settled at once. The
+    submissions compile in the `pool` of workers if given.
+    """
+    ppaths = [ppath for ppath, _ in tasks]
+    if pool is None:
+        compiled = [_compile_one(ppath, ex.program_kwds) for ppath in ppaths]
+    else:
+        compiled = list(pool.map(_compile_one, ppaths,
+                                 [ex.program_kwds] * len(ppaths)))
+    root_logger.info("Compiled %s submissions, %s do not compile.",
+                     len(ppaths), sum(_ is False for _ in compiled))
+
+
+def make_pool(checker, jobs, executor='process', checker_kwds=None,
+              result_cache=None):
+    """Start a pool of `jobs` workers for `mark_cohort`.
+
+    Returns a ThreadPoolExecutor or a ProcessPoolExecutor for the `executor`,
+    or None for ``'asyncio'``, which has no pool. Reuse the pool for several
+    `mark_cohort` calls to keep the workers and their Exercises warm; shut it
+    down when done.
+    """
+    if executor == 'thread':
+        return ThreadPoolExecutor(max_workers=jobs)
+    elif executor == 'asyncio':
+        return None
+    elif executor == 'process':
+        initargs = (checker, checker_kwds or {}, result_cache,
+                    logs.settings())
+        return ProcessPoolExecutor(max_workers=jobs, initializer=_init_worker,
+                                   initargs=initargs)
+    else:
+        raise ValueError("Unknown executor %s." % executor)
+
+
+def group_duplicates(tasks):
+    """Group the ``(ppath, student)`` `tasks` by `Submission.fingerprint`.
+
+    Returns the list of the lists of the indices of the tasks in each group,
+    in the order of `tasks`. A folder without a submission is a group of
+    its own.
+    """
+    groups = {}
+    for j, (ppath, _) in enumerate(tasks):
+        try:
+            key = Submission(ppath).fingerprint()
+        except (ValueError, OSError):
+            key = j
+        groups.setdefault(key, []).append(j)
+    return list(groups.values())
+
+
+def duplicate_clusters(tasks):
+    """The lists of the lms_ids of the identical submissions of `tasks`."""
+    return [[name_from_path(tasks[j][0]) for j in group]
+            for group in group_duplicates(tasks) if len(group) > 1]
+
+
+def _duplicate_result(res, ppath, student):
+    """The result dict of the copy at `ppath` of the submission marked with
+    the result `res`. Also writes its log file."""
+    name = name_from_path(ppath)
+    log = ("Same code as %s, mark = %s.\n" % (res["lms_id"], res["mark"]) +
+           res["log"])
+    with open(os.path.join(ppath, name + '.log'), 'w', encoding='utf8') as f:
+        f.write(log)
+    dup = _student_result(student, name, res["mark"], log)
+    if res.get("failed"):
+        dup["failed"] = True
+    return dup
+
+
+def mark_cohort(ex, checker, tasks, root_logger, jobs=1, executor='process',
+                checker_kwds=None, result_cache=None, pool=None,
+                on_result=None, dedup=False, coordinator=None):
+    """Mark a list of ``(ppath, student)`` pairs.
+
+    With ``jobs > 1``, submissions are marked concurrently. For
+    ``executor='process'``, this uses a pool of `jobs` worker processes, each
+    of which constructs its own Exercise via the `checker` factory, called
+    with keyword arguments `checker_kwds`. For
+    ``executor='thread'``, `jobs` threads share `ex` and overlap waiting on
+    the student subprocesses. For ``executor='asyncio'``, all submissions
+    are marked from a single event loop via `Exercise.amark`, with at most
+    `jobs` student subprocesses running at any time.
+
+    Either way, returns the list of `mark_one_path` result dicts in the order
+    of `tasks`. Unchanged submissions are looked up in the `result_cache`
+    instead of being marked, if given. All submissions are compiled before
+    any of them runs, see `compile_cohort`.
+
+    The workers are started for this call and shut down after it, unless
+    a `pool` from `make_pool` is given.
+
+    If given, ``on_result(res)`` is called in this process with each result
+    dict as soon as the submission is marked, e.g. to store it.
+
+    With `dedup`, the submissions with the same code, see `group_duplicates`,
+    are only marked once, and the others get the same mark and log.
+
+    If a `coordinator` is given, the submissions are marked by its workers
+    instead, see `distributed.Coordinator`.
+    """
+    if on_result is None:
+        on_result = _ignore
+
+    if dedup:
+        groups = group_duplicates(tasks)
+        by_lms_id = {name_from_path(tasks[group[0]][0]): group
+                     for group in groups}
+        marked = [None] * len(tasks)
+
+        def fan_out(res):
+            group = by_lms_id[res["lms_id"]]
+            marked[group[0]] = res
+            on_result(res)
+            for j in group[1:]:
+                marked[j] = _duplicate_result(res, *tasks[j])
+                on_result(marked[j])
+
+        root_logger.info("Marking %s distinct submissions out of %s.",
+                         len(groups), len(tasks))
+        mark_cohort(ex, checker, [tasks[group[0]] for group in groups],
+                    root_logger, jobs, executor, checker_kwds, result_cache,
+                    pool, fan_out, coordinator=coordinator)
+        return marked
+
+    if coordinator is not None:
+        root_logger.info("Marking %s submissions on the workers of %s.",
+                         len(tasks), coordinator.address)
+        return coordinator.mark(tasks, on_result)
+
+    if jobs == 1:
+        compile_cohort(ex, tasks, root_logger)
+        marked = []
+        for ppath, student in tasks:
+            res = mark_one_path(ex.mark, ppath, student, root_logger,
+                                result_cache)
+            on_result(res)
+            marked.append(res)
+        return marked
+
+    root_logger.info("Marking %s submissions with %s %s workers.",
+                     len(tasks), jobs, executor)
+    if executor == 'asyncio':
+        with ProcessPoolExecutor(max_workers=jobs) as compile_pool:
+            compile_cohort(ex, tasks, root_logger, compile_pool)
+        # asyncio is slow to import, and only needed here
+        import asyncio
+        return asyncio.run(_amark_cohort(ex, tasks, root_logger, jobs,
+                                         result_cache, on_result))
+
+    own_pool = pool is None
+    if own_pool:
+        pool = make_pool(checker, jobs, executor, checker_kwds, result_cache)
+    try:
+        compile_cohort(ex, tasks, root_logger, pool)
+        if executor == 'thread':
+            futures = [pool.submit(mark_one_path, ex.mark, ppath, student,
+                                   root_logger, result_cache)
+                       for ppath, student in tasks]
+        else:
+            futures = [pool.submit(_mark_in_worker, ppath, student)
+                       for ppath, student in tasks]
+        for future in as_completed(futures):
+            on_result(future.result())
+        return [future.result() for future in futures]
+    finally:
+        if own_pool:
+            pool.shutdown()
+
+
+def mark_pending(ex, checker, tasks, root_logger, store, rerun=False,
+                 **kwds):
+    """Mark the ``(ppath, student)`` `tasks` and add the results to the
+    `store`, a `results.ResultStore`, as they come.
+
+    Skips the submissions which have a current result in the store already,
+    unless `rerun`: those with none of their files changed since, see
+    `Submission.digest`. The rest of the keyword arguments go to `mark_cohort`.
+    Returns the list of the folders marked.
+    """
+    digests = {}
+    pending = []
+    for ppath, student in tasks:
+        lms_id = name_from_path(ppath)
+        digests[lms_id] = (ppath, _submission_digest(ppath))
+        if rerun or not store.is_current(lms_id, digests[lms_id][1]):
+            pending.append((ppath, student))
+    if len(pending) < len(tasks):
+        root_logger.info("Skipping %s submissions marked already.",
+                         len(tasks) - len(pending))
+
+    def on_result(res):
+        # a failed result is stored as not current, to be marked again
+        ppath, digest = digests[res["lms_id"]]
+        store.add(res, ppath, None if res.get("failed") else digest)
+
+    mark_cohort(ex, checker, pending, root_logger, on_result=on_result,
+                **kwds)
+    return [ppath for ppath, _ in pending]
+
+
+def prune_results(store, folders):
+    """Remove the results of the submissions which are gone from the
+    `store`: keep those of the submission `folders` only."""
+    lms_ids = set(name_from_path(folder) for folder in folders)
+    for lms_id, _, _ in store.marks():
+        if lms_id not in lms_ids:
+            store.remove(lms_id)
+
+
+def save_results(root_path, store):
+    """Export the spreadsheet and the run report from the `store` into
+    `root_path`."""
+    # now save results to Excel, for a good measure
+    store.write_spreadsheet(os.path.join(root_path, "mark_result.xlsx"))
+
+    # and the timings, to tune the timeouts and the number of jobs
+    store.write_run_report(os.path.join(root_path, "run_report.json"),
+                           os.path.join(root_path, "run_report.csv"))
+
+
+def write_duplicates(root_path, tasks):
+    """Write the lists of the identical submissions of the ``(ppath,
+    student)`` `tasks` to ``duplicates.json`` in `root_path`. Returns them,
+    see `duplicate_clusters`."""
+    clusters = duplicate_clusters(tasks)
+    with open(os.path.join(root_path, "duplicates.json"), "w",
+              encoding="utf8") as f:
+        json.dump(clusters, f, indent=1)
+    return clusters
 
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser()
-    parser.add_argument("path",
+    parser.add_argument("path", nargs="?",
                         help="Path to exercise folder or a single exercise.")
     parser.add_argument("--only", action="store_true",
                         help="Only mark a single exercise at path.")
-    parser.add_argument("--checker", required=True,
-                        help="The checker factory (required). Given X, the "
-                              "factory is shims.get_X().")
+    parser.add_argument("--checker",
+                        help="The checker (required): a name from "
+                             "--list-checkers, or a module:factory spec.")
+    parser.add_argument("--list-checkers", action="store_true",
+                        help="List the known checkers and exit.")
+    parser.add_argument("--timeout", type=float,
+                        help="Timeout of each run of a submission, in "
+                             "seconds (default: 5).")
+    parser.add_argument("--jobs", "-j", type=int, default=1,
+                        help="Number of submissions to mark in parallel "
+                             "(default: 1).")
+    parser.add_argument("--executor", choices=["process", "thread", "asyncio"],
+                        default="process",
+                        help="Run parallel jobs in worker processes, in "
+                             "threads or as asyncio subprocesses "
+                             "(default: process).")
+    parser.add_argument("--cache-dir",
+                        help="Folder to cache the reference outputs and the "
+                             "marks of unchanged submissions in.")
+    parser.add_argument("--engine", choices=sorted(ENGINES),
+                        default="subprocess",
+                        help="Run each input in a new interpreter, in a "
+                             "child of a warm interpreter, or all inputs "
+                             "in a single process (default: subprocess).")
+    parser.add_argument("--preload", default="",
+                        help="Comma-separated modules to import into the "
+                             "warm interpreter, e.g. numpy.")
+    parser.add_argument("--n-inputs", type=int,
+                        help="Also check this many random inputs, if the "
+                             "checker has an input generator.")
+    parser.add_argument("--seed", type=int,
+                        help="Seed of the random inputs (default: 0).")
+    parser.add_argument("--max-timeouts", type=int,
+                        help="Skip the remaining inputs of a submission "
+                             "after this many consecutive timeouts.")
+    parser.add_argument("--max-repeated-errors", type=int,
+                        help="Skip the remaining inputs of a submission "
+                             "after the same error this many times in a row.")
+    parser.add_argument("--max-output", type=int,
+                        help="Keep at most this many bytes of stdout and "
+                             "stderr of each run (default: %s)." % MAX_OUTPUT)
+    parser.add_argument("--rlimit-cpu", type=int,
+                        help="Limit the CPU time of each run, in seconds.")
+    parser.add_argument("--rlimit-as", type=int,
+                        help="Limit the address space of each run, in MB.")
+    parser.add_argument("--rlimit-nproc", type=int,
+                        help="Limit the number of processes of the user in "
+                             "each run.")
+    parser.add_argument("--log-level", choices=logs.LEVELS, default="info",
+                        help="Verbosity of the log files (default: info).")
+    parser.add_argument("--console-level", choices=logs.LEVELS,
+                        default="info",
+                        help="Verbosity of the console log (default: info).")
+    parser.add_argument("--max-log", type=int,
+                        help="Keep at most this many characters of the log "
+                             "of each student in the results store "
+                             "(default: %s)." % logs.MAX_LOG)
+    parser.add_argument("--watch", action="store_true",
+                        help="Keep running, and mark the submissions as "
+                             "they arrive or change.")
+    parser.add_argument("--interval", type=float, default=5,
+                        help="Seconds between the polls in --watch mode "
+                             "(default: 5).")
+    parser.add_argument("--spool",
+                        help="In --watch mode, unpack the LMS zip archives "
+                             "dropped into this folder.")
+    parser.add_argument("--check-cache-size", type=int,
+                        help="Keep the scores of this many distinct outputs, "
+                             "0 to check every output (default: %s)."
+                             % CHECK_CACHE_SIZE)
+    parser.add_argument("--dedup", action="store_true",
+                        help="Mark the submissions with the same code, up to "
+                             "formatting and comments, only once.")
+    parser.add_argument("--rerun", action="store_true",
+                        help="Mark all submissions again, ignoring the "
+                             "cached marks.")
+    parser.add_argument("--serve", metavar="HOST:PORT",
+                        help="Hand out the submissions to the --worker "
+                             "processes which connect to HOST:PORT.")
+    parser.add_argument("--worker", metavar="HOST:PORT",
+                        help="Mark the submissions from the --serve "
+                             "coordinator at HOST:PORT, in --jobs processes.")
+    parser.add_argument("--authkey",
+                        default=os.environ.get("MARKER_AUTHKEY"),
+                        help="The shared key of --serve and --worker "
+                             "(default: $MARKER_AUTHKEY).")
+    parser.add_argument("--lease", type=float,
+                        help="With --serve, seconds a worker has to mark "
+                             "a submission before it goes to another one "
+                             "(default: %s)." % distributed.LEASE)
     args = parser.parse_args()
 
+    if args.list_checkers:
+        for name, spec in checkers.list_checkers():
+            print("%-12s %s" % (name, spec))
+        sys.exit(0)
+    if (args.serve or args.worker) and not args.authkey:
+        parser.error("--serve and --worker need an --authkey")
+    if args.worker:
+        logs.configure(args.log_level, args.console_level, args.max_log)
+        distributed.run_workers(distributed.parse_address(args.worker),
+                                args.authkey.encode('utf8'), args.jobs)
+        sys.exit(0)
+    if args.path is None or args.checker is None:
+        parser.error("the path and --checker are required")
+    if args.jobs < 1:
+        parser.error("--jobs must be at least 1")
+    if args.executor == "asyncio" and args.engine != "subprocess":
+        parser.error("--executor asyncio runs each input in a new "
+                     "interpreter, use it with --engine subprocess")
+    if (args.watch or args.serve) and args.only:
+        parser.error("--watch and --serve mark a cohort, not a single "
+                     "submission")
+
     a_path = os.path.abspath(args.path)
     if not os.path.exists(a_path):
         raise ValueError("Path %s does not exist" % args.path)
@@ -346,20 +1768,115 @@ if __name__ == "__main__":
         root_dir = os.getcwd()
 
     # set up the root logger
+    logs.configure(args.log_level, args.console_level, args.max_log)
     root_logger = setup_logger('root',
                                log_file=os.path.join(root_dir, 'root_log.log'))
 
     # select the exercise to mark
-    #   XXX: some more flexibility: for now shims.py is hardcoded;
-    #        a global registry of checkers? use --checker=module.factory CLI syntax? 
-    shims = __import__('shims')
-    factory = getattr(shims, 'get_'+args.checker)
-    ex = factory(logger=root_logger)
+    checker_kwds = {}
+    if args.timeout is not None:
+        checker_kwds["timeout"] = args.timeout
+    if args.n_inputs is not None:
+        checker_kwds["n_inputs"] = args.n_inputs
+    if args.seed is not None:
+        checker_kwds["seed"] = args.seed
+    if args.cache_dir is not None:
+        checker_kwds["cache_dir"] = os.path.abspath(args.cache_dir)
+    if args.engine != "subprocess":
+        checker_kwds["engine"] = args.engine
+        checker_kwds["preload"] = [_ for _ in args.preload.split(",") if _]
+    if args.max_output is not None:
+        checker_kwds["max_output"] = args.max_output
+    limits = {"cpu": args.rlimit_cpu,
+              "as": args.rlimit_as * 2**20 if args.rlimit_as else None,
+              "nproc": args.rlimit_nproc}
+    if any(_ is not None for _ in limits.values()):
+        checker_kwds["limits"] = limits
+    if args.check_cache_size is not None:
+        checker_kwds["check_cache_size"] = args.check_cache_size
+    if args.max_timeouts is not None:
+        checker_kwds["max_timeouts"] = args.max_timeouts
+    if args.max_repeated_errors is not None:
+        checker_kwds["max_repeated_errors"] = args.max_repeated_errors
+    ex = get_exercise(args.checker, root_logger, **checker_kwds)
+
+    result_cache = None
+    if args.cache_dir is not None and not args.rerun:
+        result_cache = ResultCache(args.cache_dir, args.checker, ex)
 
     # Get the cohort: names, LMS ids etc
     cohort = fill_cohort()
 
+    # the results go to the store as they come, see results.py
+    store = None
+    if not args.only:
+        store = ResultStore(os.path.join(root_dir, STORE_NAME),
+                            digest(args.checker, ex.fingerprint()))
+    mark_kwds = dict(jobs=args.jobs, executor=args.executor,
+                     checker_kwds=checker_kwds, result_cache=result_cache,
+                     dedup=args.dedup)
+    coordinator = None
+    if args.serve:
+        coordinator = distributed.Coordinator(
+            distributed.parse_address(args.serve),
+            args.authkey.encode('utf8'), args.checker, checker_kwds,
+            root_logger, lease=args.lease or distributed.LEASE)
+        mark_kwds["coordinator"] = coordinator
+        print("Serving the workers at %s:%s." % coordinator.address)
+
+    def make_task(ppath):
+        # assume the folder name is the lms_id
+        lms_id = name_from_path(ppath)
+        try:
+            student = cohort[lms_id]
+        except KeyError:
+            student = Student(lms_id)
+        return ppath, student
+
     # Mark it
+    if args.watch:
+        from watch import Watcher
+
+        pool = None
+        if args.jobs > 1 and coordinator is None:
+            pool = make_pool(args.checker, args.jobs, args.executor,
+                             checker_kwds, result_cache)
+
+        def mark_tasks(tasks):
+            mark_pending(ex, args.checker, tasks, root_logger, store,
+                         rerun=args.rerun, pool=pool, **mark_kwds)
+
+        def on_update(ready, removed):
+            for ppath in removed:
+                store.remove(name_from_path(ppath))
+            save_results(root_dir, store)
+            ready = set(name_from_path(_) for _ in ready)
+            for lms_id, name, mark in store.marks():
+                if lms_id in ready:
+                    print("%s : %s" % (name, round(mark)))
+
+        unpack = None
+        if args.spool is not None:
+            unpack = functools.partial(LMSzip.unpack, name_dict=cohort,
+                                       jobs=args.jobs, dest=root_dir)
+        watcher = Watcher(root_dir, make_task, mark_tasks, on_update,
+                          root_logger, interval=args.interval,
+                          spool=args.spool, unpack=unpack)
+        # forget the folders which went while nobody was watching
+        prune_results(store, next(os.walk(root_dir))[1])
+        print("Watching %s, press Ctrl-C to stop." % root_dir)
+        try:
+            watcher.run()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            if pool is not None:
+                pool.shutdown()
+            if coordinator is not None:
+                coordinator.close()
+            store.close()
+        sys.exit(0)
+
     if args.only:
         # assume the folder name is the lms_id
         lms_id = name_from_path(args.path)
@@ -367,11 +1884,10 @@ if __name__ == "__main__":
             student = cohort[lms_id]
         except KeyError:
             student = Student(lms_id)
-            cohort.update({lms_id: student})
 
-        res = mark_one_path(ex.mark, args.path, student, root_logger)
-        student.mark = res["mark"]
-        results = [student]
+        res = mark_one_path(ex.mark, args.path, student, root_logger,
+                            result_cache)
+        results = [(student.name, res["mark"])]
 
     else:
         # walk: **Use abspaths, see os.walk docstring's last line**
@@ -382,38 +1898,28 @@ if __name__ == "__main__":
         #    - student_2
         #    - student_3
         # where each student_# is a directory with an executable. 
-        results = []
+        # Sort the folders so that the spreadsheet order is reproducible.
         root_path, dirs, fnames = next(os.walk(root_dir))
-        for folder in dirs:
-
-            lms_id = folder   # assume this
-            try:
-                student = cohort[lms_id]
-            except KeyError:
-                student = Student(lms_id)
-
-            ppath = os.path.join(root_path, folder)
-            res = mark_one_path(ex.mark, ppath, student, root_logger)
-
-            student.mark = round(res["mark"])
-            student.log = res["log"]
-            results.append(student)
-
-
-        # now save results to Excel, for a good measure
-        xls_path = os.path.join(root_path, "mark_result.xlsx")
-        wb = openpyxl.Workbook()
-        ws = wb.active
-        ws["A1"], ws["B1"], ws["C1"] = "Name", "Mark", "Log"
-        for row, student in enumerate(results):
-            ws["A" + str(row+2)] = student.name
-            ws["B" + str(row+2)] = student.mark
-            ws["C" + str(row+2)] = student.log
-        wb.save(xls_path)
+        tasks = [make_task(os.path.join(root_path, folder))
+                 for folder in sorted(dirs)]
+
+        # forget the folders which are gone, and resume from the store
+        prune_results(store, dirs)
+        mark_pending(ex, args.checker, tasks, root_logger, store,
+                     rerun=args.rerun, **mark_kwds)
+        save_results(root_path, store)
+        clusters = write_duplicates(root_path, tasks)
+        if clusters:
+            print("%s groups of identical submissions, see duplicates.json."
+                  % len(clusters))
+        results = [(name, round(mark)) for _, name, mark in store.marks()]
+        store.close()
+        if coordinator is not None:
+            coordinator.close()
 
     # print out the summary
-    maxlen = max(len(_.name) for _ in results)
+    maxlen = max(len(name) for name, _ in results)
     fmt = "%"  + str(maxlen) + "s"
     print("\n\n", "*"*20, " Marks summary:")
-    for entry in results:
-        print(fmt % entry.name, " : ", entry.mark)
+    for name, mark in results:
+        print(fmt % name, " : ", mark)
@@ -0,0 +1,157 @@
+"""
+Jupyter notebook submissions.
+
+The code cells of a notebook are extracted into a plain python script, which
+then runs as any other submission: no kernel is started. The scripts are
+cached in a folder, keyed by the digest of the notebook, so that a notebook
+is only converted once.
+
+IPython magics have no meaning in a plain script: line magics and shell
+escapes are replaced by ``pass``, and cells of cell magics other than
+the timing ones are skipped.
+"""
+from __future__ import division, print_function, absolute_import
+
+import os
+import json
+import tempfile
+
+from cache import digest, private_folder
+
+# The default folder for the scripts extracted from the notebooks, one per
+# user.
+SCRIPT_DIR = os.path.join(tempfile.gettempdir(),
+                          "marker-notebooks-%s" % os.getuid())
+
+# Bump when the extraction changes, to invalidate the cached scripts.
+VERSION = 1
+
+# Cell magics whose cells are still plain python.
+PYTHON_CELL_MAGICS = ("time", "timeit", "capture")
+
+
+def _source(cell):
+    src = cell.get("source", "")
+    return "".join(src) if isinstance(src, list) else src
+
+
+def _cell_code(src):
+    """The python code of the cell source `src`, or None to skip the cell."""
+    lines = src.splitlines()
+    if lines and lines[0].startswith("%%"):
+        magic = lines[0][2:].split(None, 1)[0] if lines[0][2:] else ""
+        if magic not in PYTHON_CELL_MAGICS:
+            return None
+        lines = lines[1:]
+
+    # a magic is a line magic or a shell command only at the start of a
+    # logical line, else it is the % operator, say; the backslash
+    # continuation lines of a magic are part of it
+    code = []
+    state = (0, None)
+    in_magic = False
+    for line in lines:
+        stripped = line.lstrip()
+        indent = line[:len(line) - len(stripped)]
+        if in_magic:
+            code.append(indent + "# " + stripped)
+            in_magic = line.endswith("\\")
+        elif state == (0, None) and stripped.startswith(("%", "!")):
+            code.append(indent + "pass  # " + stripped)
+            in_magic = line.endswith("\\")
+        else:
+            state = _scan(line, *state)
+            code.append(line)
+    return "\n".join(code)
+
+
+def _scan(line, depth, quote):
+    """Scan a line of code, given the `depth` of the open brackets and the
+    open `quote` of a string before it.
+
+    Returns ``(depth, quote)`` after the line; these are ``(0, None)`` if the
+    next line starts a logical line. A backslash continuation counts as
+    ``depth = -1``.
+    """
+    depth = max(depth, 0)
+    j = 0
+    while j < len(line):
+        c = line[j]
+        if quote is not None:
+            if c == "\\":
+                j += 2
+                continue
+            if line.startswith(quote, j):
+                j += len(quote)
+                quote = None
+                continue
+        elif c == "#":
+            break
+        elif c in "\"'":
+            quote = line[j:j + 3] if line[j:j + 3] in ('"""', "'''") else c
+            j += len(quote)
+            continue
+        elif c in "([{":
+            depth += 1
+        elif c in ")]}":
+            depth = max(depth - 1, 0)
+        j += 1
+    else:
+        if line.endswith("\\") and depth == 0 and (quote is None or
+                                                  len(quote) == 1):
+            return -1, quote
+    if quote is not None and len(quote) == 1:
+        # an unterminated string, which only a backslash continues
+        quote = None
+    return depth, quote
+
+
+def extract_code(nb_path):
+    """The code of the code cells of the notebook at `nb_path`, as a script.
+    """
+    with open(nb_path, encoding="utf8") as f:
+        nb = json.load(f)
+
+    futures, chunks = [], []
+    for j, cell in enumerate(nb.get("cells", [])):
+        if cell.get("cell_type") != "code":
+            continue
+        code = _cell_code(_source(cell))
+        if code is None:
+            continue
+        # each cell is compiled on its own in a kernel, so __future__
+        # imports are fine in any cell; in a script, they go first
+        lines = code.split("\n")
+        futures += [_ for _ in lines if _.startswith("from __future__ ")]
+        code = "\n".join(_ for _ in lines
+                         if not _.startswith("from __future__ "))
+        chunks.append("# In[%s]:\n%s\n" % (j, code))
+    return "".join(_ + "\n" for _ in futures) + "\n".join(chunks)
+
+
+def notebook_script(nb_path, script_dir=None):
+    """Extract the code of the notebook `nb_path` into a script.
+
+    Returns the path to the script, ``script_dir/<notebook digest>.py``. If
+    the script is there already, the notebook is only hashed, not parsed.
+    Raises ValueError if the notebook is not valid JSON.
+    """
+    # the scripts run: nobody else may put them there
+    script_dir = private_folder(script_dir or SCRIPT_DIR)
+    with open(nb_path, "rb") as f:
+        key = digest(VERSION, f.read())
+    script = os.path.join(script_dir, key + ".py")
+    if os.path.exists(script):
+        return script
+
+    try:
+        code = extract_code(nb_path)
+    except (ValueError, UnicodeDecodeError) as e:
+        raise ValueError("%s is not a notebook: %s" % (nb_path, e))
+
+    # write atomically: several marking processes may share script_dir
+    fd, tmp = tempfile.mkstemp(dir=script_dir, suffix=".tmp")
+    with os.fdopen(fd, "w", encoding="utf8") as f:
+        f.write(code)
+    os.replace(tmp, script)
+    return script
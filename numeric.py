@@ -0,0 +1,204 @@
+"""
+Shims for the numeric problems of lab_1, see `shims`.
+
+`NumericExercise` checks all outputs of a submission in one vectorized pass.
+This module imports numpy and lab_1, so it is only imported when one of its
+checkers is selected, see `checkers`.
+"""
+from __future__ import division, print_function, absolute_import
+
+import itertools
+
+import numpy as np
+
+from marking import Exercise
+
+import lab_1
+
+
+# Match unordered outputs of up to this many numbers in all orders.
+MAX_PERMUTED = 6
+
+
+class NumericExercise(Exercise):
+    """An Exercise whose outputs are a few numbers each.
+
+    All outputs of a submission are parsed into arrays, and checked against
+    the reference outputs at once, by `_check_arrays`. The outputs of the
+    same length are checked in one vectorized pass, so that marking many
+    inputs costs numpy time rather than interpreter time.
+
+    Parameters
+    ----------
+    rtol, atol : float
+        The tolerances of the comparison, see `numpy.isclose`.
+    unordered : bool
+        If True, the numbers in an output may come in any order, e.g. the
+        roots of an equation.
+    dtype : numpy dtype
+        The dtype to parse the numbers into, float or complex.
+
+    Other arguments are passed to `Exercise`.
+    """
+    _scoring_methods = Exercise._scoring_methods + ("_as_array",
+                                                    "_check_arrays")
+    _scoring_params = ("rtol", "atol", "unordered", "dtype")
+
+    def __init__(self, *args, **kwds):
+        self.rtol = kwds.pop('rtol', 1e-5)
+        self.atol = kwds.pop('atol', 1e-8)
+        self.unordered = kwds.pop('unordered', True)
+        self.dtype = kwds.pop('dtype', float)
+        super(NumericExercise, self).__init__(*args, **kwds)
+
+    def _parse_output(self, inp, outp, this_logger):
+        # whitespace or comma-separated numbers, in parentheses or not
+        outp = outp.strip()
+        if outp.startswith('(') and outp.endswith(')'):
+            outp = outp[1:-1]
+        return np.array(outp.replace(',', ' ').split(), dtype=self.dtype)
+
+    def _as_array(self, base_outp):
+        """The reference output `base_outp` as a 1D array."""
+        return np.asarray(base_outp, dtype=self.dtype).ravel()
+
+    def _check_arrays(self, inps, outp, base_outp, this_logger):
+        """Check the outputs for `inps` against the reference outputs.
+
+        `outp` and `base_outp` are 2D arrays, a row per input. Returns the
+        array of results, out of 100 each.
+        """
+        if outp.shape != base_outp.shape:
+            # wrong number of values
+            return np.zeros(len(inps))
+        if not self.unordered:
+            perms = [slice(None)]
+        elif outp.shape[1] <= MAX_PERMUTED:
+            # try all orders: sorting is fragile for near ties, e.g. the
+            # real parts of complex conjugate roots
+            perms = [list(_) for _ in
+                     itertools.permutations(range(outp.shape[1]))]
+        else:
+            outp, base_outp = np.sort(outp, axis=1), np.sort(base_outp, axis=1)
+            perms = [slice(None)]
+        ok = np.zeros(len(inps), dtype=bool)
+        for perm in perms:
+            ok |= np.isclose(outp[:, perm], base_outp,
+                             rtol=self.rtol, atol=self.atol).all(axis=1)
+        return 100 * ok
+
+    def _check(self, inp, outp, base_outp, this_logger):
+        return self._check_arrays([inp], np.asarray(outp)[None, :],
+                                  self._as_array(base_outp)[None, :],
+                                  this_logger)[0]
+
+    def _score_all(self, inps, outps, errs, logger, timings, indices=None):
+        if indices is None:
+            indices = range(len(inps))
+        results = np.zeros(len(inps))
+
+        # parse the outputs one by one, group them by their lengths
+        groups = {}
+        for j, (inp, outp, err) in enumerate(zip(inps, outps, errs)):
+            if err:
+                logger.error("stderr is \n===\n%s\n===\n", err)
+                continue
+            logger.info("Received output for input %s: %s.", inp, outp)
+            base_outp = self._as_array(self._base_output(inp, logger,
+                                                         timings))
+            try:
+                with timings.timed("parse", input=indices[j]):
+                    outp_ = self._parse_output(inp, outp, logger)
+            except Exception as e:
+                logger.error("Failed to parse the output: \n===\n %s\n===\n"
+                             "Exception: %s ", outp, e,
+                             extra={"inputs": [indices[j]]})
+                continue
+            if not outp_.size:
+                continue
+            key = (outp_.size, base_outp.size)
+            groups.setdefault(key, []).append((j, outp_, base_outp))
+
+        # and check each group at once
+        for group in groups.values():
+            idx = [_[0] for _ in group]
+            try:
+                with timings.timed("check", count=len(idx)):
+                    results[idx] = self._check_arrays(
+                        [inps[_] for _ in idx],
+                        np.stack([_[1] for _ in group]),
+                        np.stack([_[2] for _ in group]), logger)
+            except Exception as e:
+                logger.error("Checking raised:  %s.", e,
+                             extra={"inputs": [indices[_] for _ in idx]})
+        return results.tolist()
+
+
+class Ex1_7(NumericExercise):
+    """Shim for Ex1.7: machine epsilon, zero, inf."""
+    def __init__(self, *args, **kwds):
+        super(Ex1_7, self).__init__(*args, **kwds)
+
+    def _as_array(self, base_outp):
+        # the reference output is not used: _check_arrays checks the
+        # properties of the numbers instead
+        return np.zeros(0)
+
+    def _check_arrays(self, inps, outp, base_outp, this_logger):
+        if outp.shape[1] != 3:
+            return np.zeros(len(inps))
+        eps, zero, inf = outp.T
+        with np.errstate(over='ignore'):
+            eps_ok = (eps > 0) & (1 + eps/2 == 1) & (1 + eps != 1)
+            zero_ok = (zero > 0) & (zero/2 == 0)
+            inf_ok = (inf < np.inf) & (inf*4 == np.inf)
+        return 100 * (eps_ok.astype(int) + zero_ok + inf_ok) / 3
+
+
+def get_ex1_7(*args, **kwds):
+    """Create an instance of Ex7 class with correct solve-func.
+    """
+    return Ex1_7(lab_1.Problem7().solve, *args, **kwds)
+
+
+
+class ExQ(NumericExercise):
+    """Quadratic equation."""
+    def __init__(self, *args, **kwds):
+        kwds.setdefault('dtype', complex)
+        super(ExQ, self).__init__(*args, **kwds)
+
+    def _prepare_input(self, inp):
+        return str(inp['b']) + '\n' + str(inp['c'])
+
+    def _check_arrays(self, inps, outp, base_outp, this_logger):
+        # the smallest root is accurate, the other one is via Vieta
+        smallest = np.take_along_axis(outp, abs(outp).argmin(axis=1)[:, None],
+                                      axis=1)[:, 0]
+
+        # the smallest base root is either of the roots of the same
+        # magnitude, e.g. complex conjugate ones, in any order
+        base_abs = abs(base_outp)
+        base_smallest = np.isclose(base_abs, base_abs.min(axis=1)[:, None],
+                                   rtol=self.rtol, atol=0)
+        res1 = (np.isclose(smallest[:, None], base_outp, rtol=self.rtol,
+                           atol=self.atol) & base_smallest).any(axis=1)
+
+        c = np.array([inp['c'] for inp in inps])
+        res2 = np.isclose(outp.prod(axis=1), c, rtol=self.rtol,
+                          atol=self.atol)
+        return 100 * (res1 & res2)
+
+def random_quadratic(rng):
+    """A random ``x**2 + b*x + c`` variant, with ``b`` from 1e-2 to 1e6."""
+    b = rng.choice([-1, 1]) * 10**rng.uniform(-2, 6)
+    c = rng.uniform(-5, 5)
+    return {'b': b, 'c': c}
+
+
+def get_ex_q(*args, **kwds):
+    """Create an instance of ExQ class with correct solve-func.
+    """
+    p = lab_1.ProblemQ()
+    kwds.setdefault("input_generator", random_quadratic)
+    return ExQ(p.solve, inputs=p.variants, **kwds)
@@ -0,0 +1,123 @@
+"""
+Timing and resource instrumentation of marking, and the run report.
+
+`Timings` collects per-phase timings of marking a single submission: compile,
+each run of the program, the base program run, parsing and checking of the
+output. `write_run_report` summarizes them over the cohort, in JSON and CSV.
+"""
+from __future__ import division, print_function, absolute_import
+
+import csv
+import json
+import time
+import contextlib
+
+
+class Timings(object):
+    """Per-phase timings of marking a single submission.
+
+    Each entry of `self.phases` is a dict with the ``phase`` name, its
+    duration in ``seconds`` and whatever else was given to `timed`, e.g.
+    the index of the ``input`` or the resource usage of a run.
+    """
+    def __init__(self):
+        self.phases = []
+
+    @contextlib.contextmanager
+    def timed(self, phase, **info):
+        """Time the body of the ``with`` block as `phase`.
+
+        Yields the dict of the entry, so that the body can add to it.
+        """
+        entry = dict(phase=phase, **info)
+        start = time.perf_counter()
+        try:
+            yield entry
+        finally:
+            entry["seconds"] = time.perf_counter() - start
+            self.phases.append(entry)
+
+
+def percentiles(values, qs=(50, 90, 99)):
+    """The nearest-rank percentiles of `values`, plus the max, as a dict."""
+    values = sorted(values)
+    if not values:
+        return {}
+    res = {}
+    for q in qs:
+        rank = max(int(-(-q * len(values) // 100)), 1)
+        res["p%s" % q] = values[rank - 1]
+    res["max"] = values[-1]
+    return res
+
+
+def summarize(results, num_slowest=10):
+    """Summarize the timings in the `mark_one_path` result dicts.
+
+    Returns a dict with the cohort-level percentiles of the time per
+    submission and per phase, the slowest submissions and runs, and the
+    hits and misses of the check cache, see `Exercise`.
+    """
+    submissions, runs, by_phase = [], [], {}
+    hits = misses = 0
+    for res in results:
+        submissions.append((res["seconds"], res["lms_id"]))
+        for entry in res["phases"]:
+            by_phase.setdefault(entry["phase"], []).append(entry["seconds"])
+            if entry["phase"] == "run":
+                runs.append((entry["seconds"], res["lms_id"],
+                             entry.get("input")))
+            elif entry["phase"] == "lookup":
+                hits += entry["hits"]
+                misses += entry["misses"]
+
+    submissions.sort(reverse=True)
+    runs.sort(key=lambda _: _[0], reverse=True)
+    return {
+        "num_submissions": len(results),
+        "total_seconds": sum(_[0] for _ in submissions),
+        "submission_seconds": percentiles([_[0] for _ in submissions]),
+        "phase_seconds": {phase: dict(percentiles(values),
+                                      count=len(values), total=sum(values))
+                          for phase, values in sorted(by_phase.items())},
+        "slowest_submissions": [{"lms_id": lms_id, "seconds": seconds}
+                                for seconds, lms_id in
+                                submissions[:num_slowest]],
+        "slowest_runs": [{"lms_id": lms_id, "input": inp, "seconds": seconds}
+                         for seconds, lms_id, inp in runs[:num_slowest]],
+        "check_cache": {"hits": hits, "misses": misses,
+                        "hit_rate": (hits / (hits + misses)
+                                     if hits + misses else None)},
+    }
+
+
+CSV_FIELDS = ["lms_id", "phase", "input", "seconds", "cpu_time", "max_rss",
+              "timed_out"]
+
+
+def write_run_report(results, json_path, csv_path=None):
+    """Write the run report for the `mark_one_path` result dicts.
+
+    The JSON file has the `summarize` summary and the per-phase timings of
+    each submission; the CSV file, if `csv_path` is given, has a row per
+    phase of each submission.
+    """
+    report = {"summary": summarize(results),
+              "submissions": [{"lms_id": res["lms_id"],
+                               "mark": res["mark"],
+                               "seconds": res["seconds"],
+                               "cached": res.get("cached", False),
+                               "phases": res["phases"]}
+                              for res in results]}
+    with open(json_path, "w", encoding="utf8") as f:
+        json.dump(report, f, indent=1)
+
+    if csv_path is not None:
+        with open(csv_path, "w", newline="", encoding="utf8") as f:
+            writer = csv.DictWriter(f, fieldnames=CSV_FIELDS,
+                                    extrasaction="ignore")
+            writer.writeheader()
+            for res in results:
+                for entry in res["phases"]:
+                    writer.writerow(dict(entry, lms_id=res["lms_id"]))
+    return report
@@ -0,0 +1,154 @@
+"""
+The results of marking a cohort, on disk.
+
+Each result is written to a SQLite database as soon as the submission is
+marked, so that a crashed or interrupted run keeps what it has marked, and
+a rerun only marks the submissions which are not in the store yet, or which
+changed since. The spreadsheet and the run report are exported from the
+store, row by row.
+
+The logs are kept in the store, and in the log files in the student folders.
+The spreadsheet only gets the start of each log, and the path to its file.
+"""
+from __future__ import division, print_function, absolute_import
+
+import os
+import json
+import time
+import sqlite3
+
+from report import write_run_report
+
+# The default file name of the store, in the cohort folder.
+STORE_NAME = "mark_results.sqlite"
+
+# Keep at most this many characters of a log in a spreadsheet cell.
+LOG_CELL = 2000
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS results (
+    lms_id TEXT PRIMARY KEY,
+    name TEXT,
+    exercise TEXT,
+    digest TEXT,
+    mark REAL,
+    seconds REAL,
+    cached INTEGER,
+    phases TEXT,
+    log TEXT,
+    log_file TEXT,
+    marked_at REAL
+)
+"""
+
+_COLUMNS = ["lms_id", "name", "exercise", "digest", "mark", "seconds",
+            "cached", "phases", "log", "log_file", "marked_at"]
+
+
+class ResultStore(object):
+    """The `mark_one_path` result dicts of a cohort, in a SQLite file.
+
+    Parameters
+    ----------
+    path : str
+        The database file. It is created if needed.
+    exercise : str
+        A key of the checker and the exercise, e.g. a digest of the checker
+        name and `Exercise.fingerprint`. Results stored for another key are
+        out of date, see `is_current`.
+    """
+    def __init__(self, path, exercise):
+        self.path = os.path.abspath(path)
+        self.exercise = exercise
+        self._conn = sqlite3.connect(self.path)
+        # a result is on disk once `add` returns, and readers do not block it
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute(_SCHEMA)
+        self._conn.commit()
+
+    def close(self):
+        self._conn.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def add(self, res, ppath=None, digest=None):
+        """Store the `mark_one_path` result dict `res`.
+
+        `ppath` is the submission folder, to point at its log file, and
+        `digest` the digest of the submission, see `Submission.digest`.
+        Replaces a previous result of the same student.
+        """
+        log_file = None
+        if ppath is not None:
+            log_file = os.path.join(os.path.abspath(ppath),
+                                    res["lms_id"] + ".log")
+        row = (res["lms_id"], res["name"], self.exercise, digest,
+               res["mark"], res["seconds"], int(res.get("cached", False)),
+               json.dumps(res["phases"]), res["log"], log_file, time.time())
+        with self._conn:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO results VALUES (%s)"
+                % ", ".join("?" * len(_COLUMNS)), row)
+
+    def remove(self, lms_id):
+        with self._conn:
+            self._conn.execute("DELETE FROM results WHERE lms_id = ?",
+                               (lms_id,))
+
+    def is_current(self, lms_id, digest):
+        """Whether the stored result of `lms_id` is for this exercise and
+        for the submission with this `digest`, see `marking.Submission`."""
+        if digest is None:
+            return False
+        row = self._conn.execute(
+            "SELECT 1 FROM results WHERE lms_id = ? AND exercise = ? AND "
+            "digest = ?", (lms_id, self.exercise, digest)).fetchone()
+        return row is not None
+
+    def results(self, with_log=True):
+        """Iterate over the stored result dicts, sorted by the lms_id.
+
+        The result dicts also have the ``log_file``. Skip reading the logs
+        unless `with_log`.
+        """
+        columns = [_ for _ in _COLUMNS if with_log or _ != "log"]
+        cursor = self._conn.execute("SELECT %s FROM results ORDER BY lms_id"
+                                    % ", ".join(columns))
+        for row in cursor:
+            res = dict(zip(columns, row))
+            res["phases"] = json.loads(res["phases"])
+            res["cached"] = bool(res["cached"])
+            yield res
+
+    def marks(self):
+        """The sorted list of ``(lms_id, name, mark)``."""
+        return self._conn.execute(
+            "SELECT lms_id, name, mark FROM results ORDER BY lms_id"
+            ).fetchall()
+
+    def write_spreadsheet(self, xls_path, max_cell=LOG_CELL):
+        """Export the names, marks and logs to Excel.
+
+        The rows are streamed into the file, and a log cell has at most
+        `max_cell` characters of the log; the full log is in the log file.
+        """
+        import openpyxl   # slow to import, and --only does not need it
+        wb = openpyxl.Workbook(write_only=True)
+        ws = wb.create_sheet()
+        ws.append(["Name", "Mark", "Log", "Log file"])
+        for res in self.results():
+            log = res["log"]
+            if len(log) > max_cell:
+                log = log[:max_cell] + "[... see the log file ...]\n"
+            ws.append([res["name"], round(res["mark"]), log, res["log_file"]])
+        wb.save(xls_path)
+
+    def write_run_report(self, json_path, csv_path=None):
+        """Export the run report, see `report.write_run_report`."""
+        return write_run_report(list(self.results(with_log=False)),
+                                json_path, csv_path)
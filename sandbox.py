@@ -0,0 +1,423 @@
+"""
+Run student scripts in children of a pre-warmed interpreter.
+
+Starting a fresh ``python`` for every input of every submission means paying
+for the interpreter startup and for importing e.g. numpy every time.
+Instead, a warm server process imports the commonly used modules once, and
+each run of a student script happens in a child forked from it.
+
+The server is this file run as a script, ``python sandbox.py serve
+[modules]``. It reads requests from stdin, one JSON object per line, and
+replies on stdout with ``started <id> <pid>`` once the child is forked and
+``done <id> <exit code>`` once it has exited. `WarmServer` is the client side.
+
+Also, ``python sandbox.py batch ...`` runs a script on several inputs in a
+single process, see `run_batch`.
+
+This module is imported into the server and its children, so it should
+stay light on imports.
+"""
+from __future__ import division, print_function, absolute_import
+
+import io
+import os
+import sys
+import json
+import builtins
+import signal
+import runpy
+import selectors
+import threading
+import atexit
+import resource
+from subprocess import Popen, PIPE
+
+from launch import set_limits, print_exception
+
+
+def usage_of(rusage):
+    """The CPU time in seconds and the peak RSS in bytes from an rusage."""
+    max_rss = rusage.ru_maxrss
+    if sys.platform != 'darwin':
+        # kilobytes
+        max_rss *= 1024
+    return {'cpu_time': rusage.ru_utime + rusage.ru_stime,
+            'max_rss': max_rss}
+
+
+def killpg(pgid):
+    """Kill the process group `pgid`, if there is one.
+
+    This is also used after the group leader has exited, to kill whatever
+    processes it left behind.
+    """
+    try:
+        os.killpg(pgid, signal.SIGKILL)
+    except (ProcessLookupError, PermissionError):
+        pass
+
+
+def _redirect(path, fd, flags):
+    new_fd = os.open(path, flags)
+    os.dup2(new_fd, fd)
+    os.close(new_fd)
+
+
+def exec_script(workdir, fname, stdin_path, stdout_path, stderr_path,
+                limits=None):
+    """Run the script `fname` in `workdir` as ``python fname`` would.
+
+    The standard streams are redirected to the files at the given paths.
+    The script runs in a new process group, with resource `limits`, see
+    `set_limits`. This is meant to run in a process forked off the warm
+    server, and it does not return.
+    """
+    os.setsid()
+    set_limits(limits)
+    os.chdir(workdir)
+    _redirect(stdin_path, 0, os.O_RDONLY)
+    _redirect(stdout_path, 1, os.O_WRONLY)
+    _redirect(stderr_path, 2, os.O_WRONLY)
+    # as python sets them up: the text and the buffer writes stay in order
+    sys.stdin, sys.stdout, sys.stderr = [
+        _text_stream(open(fd, mode, closefd=False), like)
+        for fd, mode, like in ((0, 'rb', sys.stdin), (1, 'wb', sys.stdout),
+                               (2, 'wb', sys.stderr))]
+
+    path = os.path.join(workdir, fname)
+    sys.argv = [fname]
+    sys.path[0] = workdir
+
+    code = 0
+    try:
+        runpy.run_path(path, run_name='__main__')
+    except SystemExit as e:
+        if e.code is None:
+            code = 0
+        elif isinstance(e.code, int):
+            code = e.code
+        else:
+            print(e.code, file=sys.stderr)
+            code = 1
+    except BaseException as e:
+        print_exception(e, path)
+        code = 1
+    finally:
+        for stream in (sys.stdout, sys.stderr):
+            try:
+                stream.flush()
+            except Exception:
+                pass
+    os._exit(code)
+
+
+def serve(preload):
+    """The main loop of the warm server: fork a child for each request."""
+    for modname in preload:
+        try:
+            __import__(modname)
+        except ImportError:
+            pass
+
+    # get woken up by SIGCHLD, to reap the children
+    sig_r, sig_w = os.pipe()
+    os.set_blocking(sig_r, False)
+    os.set_blocking(sig_w, False)
+    signal.set_wakeup_fd(sig_w)
+    signal.signal(signal.SIGCHLD, lambda *args: None)
+
+    def reply(*words):
+        os.write(1, (" ".join(str(_) for _ in words) + "\n").encode())
+
+    selector = selectors.DefaultSelector()
+    selector.register(0, selectors.EVENT_READ)
+    selector.register(sig_r, selectors.EVENT_READ)
+
+    jobs, buf = {}, b""
+    while True:
+        for key, _ in selector.select():
+            if key.fileobj == sig_r:
+                os.read(sig_r, 65536)
+                while jobs:
+                    try:
+                        pid, status, rusage = os.wait4(-1, os.WNOHANG)
+                    except ChildProcessError:
+                        break
+                    if pid == 0:
+                        break
+                    usage = usage_of(rusage)
+                    reply("done", jobs.pop(pid),
+                          os.waitstatus_to_exitcode(status),
+                          usage['cpu_time'], usage['max_rss'])
+                continue
+
+            data = os.read(0, 65536)
+            if not data:
+                # the client has gone away
+                return
+            buf += data
+            *lines, buf = buf.split(b"\n")
+            for line in lines:
+                req = json.loads(line.decode())
+                pid = os.fork()
+                if pid == 0:
+                    signal.set_wakeup_fd(-1)
+                    signal.signal(signal.SIGCHLD, signal.SIG_DFL)
+                    selector.close()
+                    os.close(sig_r)
+                    os.close(sig_w)
+                    exec_script(req["workdir"], req["fname"], req["stdin"],
+                                req["stdout"], req["stderr"], req["limits"])
+                jobs[pid] = req["id"]
+                reply("started", req["id"], pid)
+
+
+class _Timeout(BaseException):
+    pass
+
+
+def _raise_timeout(signum, frame):
+    raise _Timeout()
+
+
+class _Overflow(BaseException):
+    pass
+
+
+class _CappedIO(io.BytesIO):
+    """An in-memory binary stream which keeps at most ``cap + 1`` bytes.
+
+    Past the cap, further writes are dropped, or raise _Overflow to stop the
+    run if `stop` is True.
+    """
+    def __init__(self, cap, stop):
+        super(_CappedIO, self).__init__()
+        self.cap, self.stop = cap, stop
+
+    def write(self, b):
+        room = self.cap + 1 - self.tell()
+        if room > 0:
+            super(_CappedIO, self).write(bytes(b)[:room])
+        if len(b) >= room and self.stop:
+            raise _Overflow()
+        return len(b)
+
+
+def _text_stream(buffer, like):
+    """A text stream over the binary `buffer`, with the encoding and the
+    error handler of the standard stream `like`, as a script run by python
+    gets them."""
+    return io.TextIOWrapper(buffer, encoding=like.encoding,
+                            errors=like.errors, newline='\n',
+                            write_through=True)
+
+
+def run_batch(workdir, fname, inputs_path, results_path, timeout,
+              max_output, stop_on_overflow=True, limits=None):
+    """Run the script `fname` in `workdir` as ``__main__`` on several inputs.
+
+    The inputs are a JSON list of strings in the file at `inputs_path`. Each
+    run of the script gets fresh globals, and its stdin, stdout and stderr are
+    in-memory streams, with a binary ``buffer`` as the real ones have. A run
+    which takes longer than `timeout` seconds is interrupted.
+
+    The results are appended to the file at `results_path` as they are ready,
+    one JSON object per line with the keys ``output``, ``err``,
+    ``timed_out`` and ``raised``. The output and the error are the bytes
+    written, decoded as latin-1. Output longer than `max_output` bytes is cut
+    to ``max_output + 1`` bytes, and the run is stopped there if
+    `stop_on_overflow` is True. A run which raised an exception may have hit
+    a difference from a real process, e.g. ``sys.stdin.fileno()``; the
+    caller should run it again in a process of its own. If this process dies,
+    the results of the inputs which were done are still there.
+
+    The resource `limits` apply to the whole batch, see `set_limits`. The
+    results also have the ``usage`` of each run, see `usage_of`: the CPU time
+    of the run, and the peak RSS of the process so far.
+    """
+    set_limits(limits)
+    os.chdir(workdir)
+    path = os.path.join(workdir, fname)
+    sys.argv = [fname]
+    sys.path[0] = workdir
+    with open(inputs_path, encoding='utf8') as f:
+        inputs = json.load(f)
+    with open(path, 'rb') as f:
+        code = compile(f.read(), path, 'exec')
+
+    signal.signal(signal.SIGALRM, _raise_timeout)
+    modules = set(sys.modules)
+    real_streams = sys.stdin, sys.stdout, sys.stderr
+    with open(results_path, 'w', encoding='utf8') as results:
+        for inp in inputs:
+            stdin = io.BytesIO(inp.encode(real_streams[0].encoding,
+                                          real_streams[0].errors))
+            sys.stdin = _text_stream(stdin, real_streams[0])
+            sys.stdout, sys.stderr = [
+                _text_stream(_CappedIO(max_output, stop_on_overflow), like)
+                for like in real_streams[1:]]
+            timed_out = raised = False
+            start = usage_of(resource.getrusage(resource.RUSAGE_SELF))
+            signal.setitimer(signal.ITIMER_REAL, timeout)
+            try:
+                exec(code, {'__name__': '__main__', '__file__': path,
+                            '__builtins__': builtins})
+            except _Timeout:
+                timed_out = True
+            except _Overflow:
+                pass
+            except SystemExit as e:
+                if e.code is not None and not isinstance(e.code, int):
+                    print(e.code, file=sys.stderr)
+            except BaseException as e:
+                print_exception(e, path)
+                raised = True
+            finally:
+                signal.setitimer(signal.ITIMER_REAL, 0)
+            output, err = [stream.buffer.getvalue().decode('latin-1')
+                           for stream in (sys.stdout, sys.stderr)]
+            usage = usage_of(resource.getrusage(resource.RUSAGE_SELF))
+            usage['cpu_time'] -= start['cpu_time']
+            sys.stdin, sys.stdout, sys.stderr = real_streams
+
+            # forget the modules the student's script imported from workdir
+            for name in set(sys.modules) - modules:
+                fname_ = getattr(sys.modules[name], '__file__', None) or ''
+                if fname_.startswith(workdir):
+                    del sys.modules[name]
+
+            json.dump({'output': output, 'err': err, 'timed_out': timed_out,
+                       'raised': raised, 'usage': usage}, results)
+            results.write('\n')
+            results.flush()
+
+
+class _Job(object):
+    """A run of a script in a child of the warm server."""
+    def __init__(self):
+        self.pid = None
+        self.returncode = None
+        self.usage = None
+        self._started = threading.Event()
+        self._done = threading.Event()
+
+    def wait(self, timeout=None):
+        """Wait for the child to exit. Return False on timeout."""
+        return self._done.wait(timeout)
+
+    def kill(self):
+        self._started.wait()
+        if self.pid is None:
+            # the server died before forking
+            return
+        killpg(self.pid)
+        if not self._done.is_set():
+            # it may not have called setsid yet; it is not reaped, so the
+            # pid is still ours
+            try:
+                os.kill(self.pid, signal.SIGKILL)
+            except ProcessLookupError:
+                pass
+
+
+class WarmServer(object):
+    """Start a warm server which has imported the modules in `preload`.
+
+    Use `submit` to run a script in a fresh child of the server. This is
+    safe to use from several threads.
+    """
+    def __init__(self, preload=()):
+        self.preload = list(preload)
+        self._proc = Popen([sys.executable, os.path.abspath(__file__),
+                            'serve'] + self.preload, stdin=PIPE, stdout=PIPE)
+        self._lock = threading.Lock()
+        self._jobs = {}
+        self._next_id = 0
+        self._reader = threading.Thread(target=self._read_replies,
+                                        daemon=True)
+        self._reader.start()
+
+    def _read_replies(self):
+        for line in self._proc.stdout:
+            what, job_id, num, *usage = line.decode().split()
+            with self._lock:
+                job = self._jobs[int(job_id)]
+            if what == "started":
+                job.pid = int(num)
+                job._started.set()
+            else:
+                job.returncode = int(num)
+                job.usage = {'cpu_time': float(usage[0]),
+                             'max_rss': int(usage[1])}
+                with self._lock:
+                    del self._jobs[int(job_id)]
+                job._done.set()
+
+        # the server is gone: nothing is going to finish
+        with self._lock:
+            jobs, self._jobs = list(self._jobs.values()), {}
+        for job in jobs:
+            job._started.set()
+            job._done.set()
+
+    def alive(self):
+        return self._proc.poll() is None
+
+    def submit(self, workdir, fname, stdin_path, stdout_path, stderr_path,
+               limits=None):
+        """Run `fname` in `workdir`, see `exec_script`. Return a job handle."""
+        job = _Job()
+        with self._lock:
+            job_id, self._next_id = self._next_id, self._next_id + 1
+            self._jobs[job_id] = job
+            req = {"id": job_id, "workdir": workdir, "fname": fname,
+                   "stdin": stdin_path, "stdout": stdout_path,
+                   "stderr": stderr_path, "limits": limits}
+            self._proc.stdin.write((json.dumps(req) + "\n").encode())
+            self._proc.stdin.flush()
+        return job
+
+    def close(self):
+        """Stop the server."""
+        try:
+            self._proc.stdin.close()
+        except OSError:
+            pass
+        self._proc.wait()
+
+
+_servers = {}
+_servers_lock = threading.Lock()
+
+
+def warm_server(preload=()):
+    """Return a running WarmServer for `preload`, starting it if needed.
+
+    Each process gets its own servers.
+    """
+    key = (os.getpid(), tuple(preload))
+    with _servers_lock:
+        server = _servers.get(key)
+        if server is None or not server.alive():
+            server = WarmServer(preload)
+            _servers[key] = server
+    return server
+
+
+@atexit.register
+def _close_servers():
+    for (pid, _), server in _servers.items():
+        if pid == os.getpid():
+            server.close()
+
+
+if __name__ == "__main__":
+    if sys.argv[1] == 'serve':
+        serve(sys.argv[2:])
+    elif sys.argv[1] == 'batch':
+        run_batch(*sys.argv[2:6], timeout=float(sys.argv[6]),
+                  max_output=int(sys.argv[7]),
+                  stop_on_overflow=sys.argv[8] == 'stop',
+                  limits=json.loads(sys.argv[9]))
+    else:
+        raise ValueError("Unknown command %s." % sys.argv[1])
@@ -0,0 +1,161 @@
+"""
+Watch mode: mark the submissions as they arrive.
+
+A `Watcher` polls the cohort folder, and marks the submission folders which
+are new or have changed since they were last marked. The exercise, its
+reference outputs and the worker pool stay warm between the polls, so that
+a new submission is marked in about the time it takes to run it.
+
+A folder is only marked once it has stayed the same for a poll interval,
+so that a submission which is being copied in is not marked half-way. The
+same goes for the LMS archives dropped into the spool folder: these are
+unpacked into the cohort folder, and then moved to ``spool/done`` (or
+``spool/failed``).
+"""
+from __future__ import division, print_function, absolute_import
+
+import os
+import time
+import shutil
+
+# The files of a submission, see `marking.Submission.files`. Only these count
+# as changes: whatever else the student's program writes into its folder
+# must not trigger a remark.
+SUBMISSION_EXTENSIONS = (".py", ".ipynb")
+
+
+def folder_signature(folder):
+    """The sorted ``(name, size, mtime)`` of the submission files in `folder`.
+
+    Returns None if there is no such folder.
+    """
+    try:
+        entries = list(os.scandir(folder))
+    except OSError:
+        return None
+    sig = []
+    for entry in entries:
+        if entry.name.endswith(SUBMISSION_EXTENSIONS) and entry.is_file():
+            stat = entry.stat()
+            sig.append((entry.name, stat.st_size, stat.st_mtime_ns))
+    return tuple(sorted(sig))
+
+
+def _file_signature(path):
+    try:
+        stat = os.stat(path)
+    except OSError:
+        return None
+    return stat.st_size, stat.st_mtime_ns
+
+
+class Watcher(object):
+    """Mark the submission folders in `root_dir` as they arrive or change.
+
+    Parameters
+    ----------
+    root_dir : str
+        The cohort folder, with a subfolder per submission.
+    make_task : callable
+        ``make_task(ppath)`` returns the ``(ppath, student)`` task for the
+        submission folder `ppath`.
+    mark_tasks : callable
+        ``mark_tasks(tasks)`` marks a list of tasks and stores the results,
+        see `marking.mark_pending`.
+    on_update : callable
+        ``on_update(ready, removed)`` is called with the lists of the folders
+        just marked and of those gone, after each round of marking.
+    logger : logging.Logger
+    interval : float
+        Seconds between the polls.
+    spool : str, optional
+        The folder to look for new LMS archives (``*.zip``) in.
+    unpack : callable, optional
+        ``unpack(zip_path)`` unpacks an archive from the `spool` into
+        `root_dir`, see `LMSzip.unpack`.
+    """
+    def __init__(self, root_dir, make_task, mark_tasks, on_update, logger,
+                 interval=5, spool=None, unpack=None):
+        self.root_dir = os.path.abspath(root_dir)
+        self.make_task = make_task
+        self.mark_tasks = mark_tasks
+        self.on_update = on_update
+        self.logger = logger
+        self.interval = interval
+        self.spool = spool
+        self.unpack = unpack
+
+        self._seen = {}           # the signatures at the previous poll
+        self._marked = {}         # the signatures at the last marking
+        self._spool_seen = {}
+
+    def scan(self):
+        """The ``{ppath: signature}`` of the submission folders."""
+        res = {}
+        for entry in os.scandir(self.root_dir):
+            if entry.is_dir():
+                res[entry.path] = folder_signature(entry.path)
+        return res
+
+    def _drain_spool(self):
+        """Unpack the archives in the spool, which did not change since
+        the previous poll."""
+        if self.spool is None:
+            return
+        current = {}
+        for entry in os.scandir(self.spool):
+            if entry.name.endswith(".zip") and entry.is_file():
+                current[entry.path] = _file_signature(entry.path)
+        for path, sig in sorted(current.items()):
+            if sig is None or self._spool_seen.get(path) != sig:
+                continue
+            self.logger.info("Unpacking %s.", path)
+            try:
+                self.unpack(path)
+                outcome = "done"
+            except Exception as e:
+                self.logger.error("Failed to unpack %s: %s.", path, e)
+                outcome = "failed"
+            dest = os.path.join(self.spool, outcome)
+            os.makedirs(dest, exist_ok=True)
+            shutil.move(path, os.path.join(dest, os.path.basename(path)))
+            del current[path]
+        self._spool_seen = current
+
+    def poll(self):
+        """Mark the folders which changed and then stayed the same for a
+        poll. Returns the list of the folders marked."""
+        self._drain_spool()
+        current = self.scan()
+        ready = sorted(ppath for ppath, sig in current.items()
+                       if sig and sig == self._seen.get(ppath) and
+                       sig != self._marked.get(ppath))
+        self._seen = current
+
+        removed = sorted(ppath for ppath in self._marked
+                         if ppath not in current)
+        for ppath in removed:
+            del self._marked[ppath]
+
+        if ready:
+            self.logger.info("Marking %s new or changed submissions.",
+                             len(ready))
+            self.mark_tasks([self.make_task(ppath) for ppath in ready])
+            for ppath in ready:
+                self._marked[ppath] = current[ppath]
+        if ready or removed:
+            self.on_update(ready, removed)
+        return ready
+
+    def run(self, cycles=None):
+        """Poll every `interval` seconds, `cycles` times or forever.
+
+        The folders already there are marked right away.
+        """
+        self._seen = self.scan()
+        num = 0
+        while cycles is None or num < cycles:
+            self.poll()
+            num += 1
+            if cycles is None or num < cycles:
+                time.sleep(self.interval)